@@ -1,14 +1,43 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Response
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from pydantic import BaseModel
+from typing import List, Optional
 from sqlite.client import sqlite_client
+import gzip
 import json
 from enum import Enum
-from celery_tasks.tasks import run_training_module, run_prediction_module
+from celery_tasks.celery_config import celery_app
 
 from sqlite.client import SQLiteClient
+from sqlite.cache import PredictionsCache
+from utils.instrumentation import render_metrics
+from data.serialisation import render_response, timeframes
+from sqlite.task_locks import (
+    acquire_task_lock,
+    release_task_lock,
+    task_status,
+)
 
 app = FastAPI()
 
 sqlite_client = SQLiteClient()
+predictions_cache = PredictionsCache()
+
+# Amount of pids resolved by a single query of the batch predictions
+batch_chunk_size = 500
+
+# The time frames are only read for the rows published before the responses
+# were pre-rendered, so they can be rendered on the fly
+response_columns = ", ".join(
+    [
+        "response",
+        "content_encoding",
+        *(
+            f"CASE WHEN response IS NULL THEN {timeframe} END"
+            for timeframe in timeframes
+        ),
+    ]
+)
 
 
 class TimeFrameEnum(str, Enum):
@@ -21,37 +50,176 @@ class TimeFrameEnum(str, Enum):
     next_168_hour = "next_168_hour"
 
 
+class PredictionsBatch(BaseModel):
+    pids: List[str]
+    horizons: Optional[List[TimeFrameEnum]] = None
+
+
+def stored_response(row):
+    """
+    The response and its content encoding of a row selected with
+    `response_columns`, rendered from the time frames if it was not stored
+    """
+    response, content_encoding, *values = row
+    if response is None:
+        record = {
+            timeframe: json.loads(value)
+            for timeframe, value in zip(timeframes, values)
+            if value
+        }
+        return render_response(record), None
+    return response, content_encoding
+
+
+def fetch_predictions(pid: str):
+    """
+    Fetch the pre-rendered response of the `pid` and its content encoding,
+    `None` is returned if the project does not exist
+    """
+    result = sqlite_client.execute_query(
+        f"SELECT {response_columns} FROM predictions WHERE pid = ?",
+        (pid,),
+    )
+
+    if not result:
+        return None
+
+    return stored_response(result[0])
+
+
+def accepts_gzip(accept_encoding: str):
+    """
+    Whether the `Accept-Encoding` header accepts gzip, a coding with `q=0` is
+    not acceptable and `*` stands for the codings which are not listed
+    """
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        name, *params = [part.strip() for part in coding.split(";")]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities[name.lower()] = quality
+
+    for name in ("gzip", "x-gzip", "*"):
+        if name in qualities:
+            return qualities[name] > 0
+    return False
+
+
 @app.get("/predict/")
-def get_predictions(pid: str):
+def get_predictions(pid: str, accept_encoding: str = Header(default="")):
     """Get predictions for the specified `pid`"""
 
-    project_exists_query = (
-        f"SELECT pid FROM predictions WHERE pid = '{pid}' LIMIT 1"
-    )
-    project = sqlite_client.execute_query(project_exists_query)
+    prediction = predictions_cache.get_or_load(pid, fetch_predictions)
 
-    if not project:
+    if prediction is None:
         raise HTTPException(status_code=404, detail="Project does not exist.")
 
-    predictions = {}
-    for timeframe in TimeFrameEnum:
-        prediction_query = (
-            f"SELECT {timeframe.value} FROM predictions WHERE pid = '{pid}'"
-        )
-        result = sqlite_client.execute_query(prediction_query)
-
-        if result:
-            prediction_data = json.loads(result[0][0])
-            if prediction_data:
-                predictions[timeframe.value] = prediction_data
+    response, content_encoding = prediction
 
-    if not predictions:
+    if response is None:
         raise HTTPException(
             status_code=404,
             detail="Data not found. Prediction is not available.",
         )
 
-    return predictions
+    if content_encoding == "gzip":
+        # Caches must not serve the gzip response to other clients
+        headers = {"Vary": "Accept-Encoding"}
+        if accepts_gzip(accept_encoding):
+            return Response(
+                content=response,
+                media_type="application/json",
+                headers={**headers, "Content-Encoding": "gzip"},
+            )
+        return Response(
+            content=gzip.decompress(response),
+            media_type="application/json",
+            headers=headers,
+        )
+
+    return Response(content=response, media_type="application/json")
+
+
+def render_batch_line(pid, row, horizons):
+    """Render the NDJSON line of the `pid` from the raw stored JSON"""
+    pid_json = json.dumps(pid)
+
+    if row is None:
+        return f'{{"pid":{pid_json},"error":"Project does not exist."}}\n'
+
+    if horizons is None:
+        response, content_encoding = stored_response(row)
+        if response is not None and content_encoding == "gzip":
+            response = gzip.decompress(response)
+        predictions = response.decode("utf-8") if response else None
+    else:
+        predictions = ",".join(
+            f'"{horizon.value}":{value}'
+            for horizon, value in zip(horizons, row)
+            if value != "{}"
+        )
+        predictions = f"{{{predictions}}}" if predictions else None
+
+    if predictions is None:
+        return (
+            f'{{"pid":{pid_json},'
+            '"error":"Data not found. Prediction is not available."}\n'
+        )
+    return f'{{"pid":{pid_json},"predictions":{predictions}}}\n'
+
+
+def stream_batch_predictions(pids, horizons):
+    """
+    Resolve the `pids` by chunks of `batch_chunk_size` with a single query
+    each and yield a NDJSON line per pid, in the order of the request
+    """
+    if horizons is None:
+        columns = response_columns
+    else:
+        columns = ", ".join(horizon.value for horizon in horizons)
+
+    for start in range(0, len(pids), batch_chunk_size):
+        chunk = pids[start : start + batch_chunk_size]
+        placeholders = ", ".join("?" for _ in set(chunk))
+        result = sqlite_client.execute_query(
+            f"SELECT pid, {columns} FROM predictions "
+            f"WHERE pid IN ({placeholders})",
+            tuple(set(chunk)),
+        )
+        rows = {row[0]: row[1:] for row in result}
+
+        yield "".join(
+            render_batch_line(pid, rows.get(pid), horizons) for pid in chunk
+        )
+
+
+@app.post("/predict/batch")
+def get_batch_predictions(batch: PredictionsBatch):
+    """
+    Get predictions for every pid of the batch, optionally only for the
+    `horizons`, as NDJSON. Projects without predictions are reported by an
+    `error` line instead of failing the whole request
+    """
+    horizons = list(dict.fromkeys(batch.horizons)) if batch.horizons else None
+    return StreamingResponse(
+        stream_batch_predictions(batch.pids, horizons),
+        media_type="application/x-ndjson",
+    )
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Stages of the latest training and prediction runs for Prometheus"""
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4"
+    )
 
 
 if __name__ == "__main__":
@@ -60,15 +228,59 @@ if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
 
+def enqueue_task(name: str, *args):
+    """
+    Enqueue the Celery task by its name, so the API does not import the tasks
+    and the ML stack behind them. Eager mode runs the task in this process, so
+    only then the tasks are imported.
+    """
+    if celery_app.conf.task_always_eager:
+        celery_app.loader.import_default_modules()
+        return celery_app.tasks[name].delay(*args)
+    return celery_app.send_task(name, args=args)
+
+
+def trigger_run(task: str, name: str):
+    """
+    Start a run of the `task` unless one is already running, in which case the
+    run in progress is returned instead
+    """
+    run_id = acquire_task_lock(task)
+    if run_id is None:
+        return {
+            "message": f"{task.capitalize()} is already running",
+            **task_status(task),
+        }
+
+    try:
+        enqueue_task(name, run_id)
+    except Exception:
+        release_task_lock(task, run_id)
+        raise
+    return {
+        "message": f"{task.capitalize()} module triggered",
+        "run_id": run_id,
+    }
+
+
 @app.post("/run_training/")
 def trigger_training():
     """Trigger the training module via Celery"""
-    run_training_module.delay()
-    return {"message": "Training module triggered"}
+    return trigger_run("training", "celery_tasks.tasks.run_training_module")
 
 
 @app.post("/run_prediction/")
 def trigger_prediction():
     """Trigger the prediction module via Celery"""
-    run_prediction_module.delay()
-    return {"message": "Prediction module triggered"}
+    return trigger_run(
+        "prediction", "celery_tasks.tasks.run_prediction_module"
+    )
+
+
+@app.get("/status/")
+def get_status():
+    """Progress of the running training and prediction, or their last run"""
+    return {
+        "training": task_status("training"),
+        "prediction": task_status("prediction"),
+    }
@@ -0,0 +1,110 @@
+import re
+import pandas as pd
+import pyarrow as pa
+from contextlib import contextmanager
+from clickhouse.client import clickhouse_client
+from constants import columns, date_col
+
+"""
+Local stand-in for ClickHouse which serves synthetic events from a DataFrame.
+
+Only the queries of the ``memory`` ingestion are supported, as rows or as
+Arrow tables: reading the analytics table, its most recent ``created``
+timestamp and the events of the most recent hour for the predictions. The
+aggregating ingestion modes run their queries inside ClickHouse and need a
+live server.
+"""
+
+
+class QueryResult:
+    def __init__(self, result_rows):
+        self.result_rows = result_rows
+
+
+class FakeClickHouse:
+    """Connection serving the queries of ``ClickHouseClient`` from ``events``"""
+
+    def __init__(self, events):
+        self.events = events
+        self.queries = 0
+
+    def _filter_pids(self, df, query, parameters):
+        if "pid IN" in query:
+            df = df[df["pid"].isin(parameters["pids"])]
+        return df
+
+    def query(self, query, parameters=None):
+        self.queries += 1
+        if f"max({date_col})" in query:
+            return QueryResult([(self.events[date_col].max(),)])
+
+        df = self._select(query, parameters or {})
+        return QueryResult(list(df.itertuples(index=False, name=None)))
+
+    def query_arrow(self, query, parameters=None, settings=None):
+        """
+        The result as ClickHouse sends it in the Arrow format, with the
+        ``toLowCardinality`` columns as dictionaries
+        """
+        self.queries += 1
+        df = self._select(query, parameters or {})
+        dictionaries = re.findall(r"toLowCardinality\(.*?AS `?(\w+)`?", query)
+        df = df.astype({col: "category" for col in dictionaries})
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+    def _select(self, query, parameters):
+        if f"toYear({date_col}) AS year" in query:
+            return self._most_recent_hour(query, parameters)
+
+        match = re.match(r"\s*SELECT (.+?) FROM analytics", query, re.S)
+        if match:
+            projection = match.group(1).strip()
+            if projection.startswith("*"):
+                excluded = re.findall(
+                    r"`([^`]+)`", projection.split("REPLACE")[0]
+                )
+                projection = [col for col in columns if col not in excluded]
+            else:
+                projection = list(
+                    dict.fromkeys(re.findall(r"`([^`]+)`", projection))
+                )
+            df = self._filter_pids(self.events, query, parameters)
+            return df[projection]
+
+        raise NotImplementedError(f"Query is not supported: {query}")
+
+    def _most_recent_hour(self, query, parameters):
+        hour = pd.Timestamp(parameters["hour"])
+        created = self.events[date_col]
+        df = self.events[
+            (created >= hour) & (created < hour + pd.Timedelta(hours=1))
+        ]
+        df = self._filter_pids(df, query, parameters)
+        features = re.findall(r"nullIf\(toString\(`([^`]+)`\)", query)
+
+        result = pd.DataFrame(
+            {
+                "year": df[date_col].dt.year,
+                "month": df[date_col].dt.month,
+                "day": df[date_col].dt.day,
+                "day_of_week": df[date_col].dt.dayofweek,
+                "hour": df[date_col].dt.hour,
+                "pid": df["pid"],
+            }
+        )
+        for col in features:
+            result[col] = df[col].map(
+                lambda value: None if value is None else str(value)
+            )
+        return result
+
+
+@contextmanager
+def fake_clickhouse(events):
+    """Serve the queries of ``clickhouse_client`` from ``events``"""
+    connection = clickhouse_client._client
+    clickhouse_client._client = FakeClickHouse(events)
+    try:
+        yield clickhouse_client._client
+    finally:
+        clickhouse_client._client = connection
@@ -0,0 +1,89 @@
+import time
+import numpy as np
+from constants import date_col, agg_cols
+from data import load_data
+from data.feature_pipeline import FeaturePipeline
+from benchmarks.synthetic import generate_events
+from benchmarks.recording import save_results
+
+"""
+Benchmark of the feature transform: the raw events counted per pid and hour
+with ``pd.get_dummies`` and a pandas group by, as before the feature pipeline,
+against ``FeaturePipeline.transform`` into the NumPy matrix of the model.
+
+    python -m benchmarks.features
+"""
+
+cat_features = ["dv", "br", "os", "lc", "cc", "unique"]
+sizes = [10, 50, 250]
+
+
+def prepare_events(events_per_hour, seed=0):
+    """Events with the date components, as read by ``load_hourly_data``"""
+    df = generate_events(
+        projects=20, events_per_hour=events_per_hour, hours=24 * 7, seed=seed
+    )
+    df = load_data.extract_date_components(df, date_col)
+    df[cat_features] = (
+        df[cat_features].astype(str).mask(df[cat_features].isna())
+    )
+    return df[[*agg_cols, *cat_features]]
+
+
+def transform_dummies(events):
+    """Count the events with ``pd.get_dummies`` and a pandas group by"""
+    df = load_data.replace_null_values(events.copy())
+    df = load_data.add_traffic_table(df)
+    df = load_data.convert_cat_features_to_dummies(df, cat_features)
+    return df.groupby(agg_cols).sum()
+
+
+def timeit(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return result, (time.perf_counter() - start) / repeat
+
+
+def run(repeat=3):
+    results = {}
+    for events_per_hour in sizes:
+        events = prepare_events(events_per_hour)
+        pipeline = FeaturePipeline.fit(events, cat_features)
+
+        traffic, dummies_seconds = timeit(
+            lambda: transform_dummies(events), repeat
+        )
+        (keys, X), pipeline_seconds = timeit(
+            lambda: pipeline.transform(events), repeat
+        )
+
+        # Both transforms count the same events
+        expected = traffic.reindex(
+            index=keys.set_index(agg_cols).index,
+            columns=pipeline.counted_columns,
+            fill_value=0,
+        )
+        assert np.array_equal(
+            X[:, -len(pipeline.counted_columns) :], expected.to_numpy()
+        )
+
+        results[events_per_hour] = {
+            "events": len(events),
+            "rows": X.shape[0],
+            "columns": X.shape[1],
+            "dummies_us_per_event": dummies_seconds / len(events) * 1e6,
+            "pipeline_us_per_event": pipeline_seconds / len(events) * 1e6,
+        }
+        print(
+            f"{len(events):>9} events  "
+            f"dummies {results[events_per_hour]['dummies_us_per_event']:.2f}"
+            f"us/event  "
+            f"pipeline {results[events_per_hour]['pipeline_us_per_event']:.2f}"
+            f"us/event"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    save_results("features", run(), config={"sizes": sizes})
@@ -0,0 +1,81 @@
+import time
+import tracemalloc
+import pyarrow as pa
+import pandas as pd
+from constants import columns, date_col, dictionary_columns
+from clickhouse.client import arrow_to_frame
+from benchmarks.synthetic import generate_events
+from benchmarks.recording import save_results
+
+"""
+Benchmark of the conversion of a ClickHouse result into a DataFrame: the
+``result_rows`` of ``query``, a tuple of Python objects per row, against the
+Arrow table of ``query_frame`` with the low cardinality columns as
+dictionaries. Both results are built from synthetic events, so only the
+conversion on the client is measured, not the transfer from ClickHouse.
+
+    python -m benchmarks.fetch
+"""
+
+sizes = [10, 50, 250]
+read_columns = [
+    col for col in columns if col not in ("meta.key", "meta.value")
+]
+
+
+def query_results(events_per_hour, seed=0):
+    """The events as ``result_rows`` and as the Arrow table of ClickHouse"""
+    df = generate_events(
+        projects=20, events_per_hour=events_per_hour, hours=24 * 7, seed=seed
+    )[read_columns]
+    rows = list(df.itertuples(index=False, name=None))
+    table = pa.Table.from_pandas(
+        df.astype({col: "category" for col in dictionary_columns}),
+        preserve_index=False,
+    )
+    return rows, table
+
+
+def measure(function):
+    """Wall time and peak of the allocations traced by ``tracemalloc``"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    df = function()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return df, seconds, peak / 1024**2
+
+
+def run():
+    results = {}
+    for events_per_hour in sizes:
+        rows, table = query_results(events_per_hour)
+        conversions = {
+            "rows": lambda: pd.DataFrame(rows, columns=read_columns),
+            "arrow": lambda: arrow_to_frame(table),
+        }
+
+        result = {"events": len(rows)}
+        for name, conversion in conversions.items():
+            df, seconds, peak = measure(conversion)
+            result[name] = {
+                "seconds": seconds,
+                "peak_mb": peak,
+                "frame_mb": df.memory_usage(deep=True).sum() / 1024**2,
+                "date_dtype": str(df[date_col].dtype),
+            }
+        results[events_per_hour] = result
+
+        print(f"{len(rows):>9} events")
+        for name in conversions:
+            print(
+                f"    {name:<8}{result[name]['seconds']:8.3f}s  "
+                f"peak {result[name]['peak_mb']:8.1f}MB  "
+                f"frame {result[name]['frame_mb']:8.1f}MB"
+            )
+    return results
+
+
+if __name__ == "__main__":
+    save_results("fetch", run(), config={"sizes": sizes})
@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import random
+import tempfile
+import pandas as pd
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from data.serialisation import (
+    build_target_layout,
+    serialise_prediction_array,
+    serialise_predictions,
+    serialise_data_for_sqlite,
+    timeframes,
+)
+from sqlite.client import SQLiteClient
+from benchmarks.recording import save_results
+
+"""
+Benchmark of the predictions store: the seven JSON columns which are parsed
+and encoded again by the API against the pre-rendered response blobs, and the
+serialisation of the model output through JSON and the regex against the
+target layout.
+
+    python -m benchmarks.predictions_store
+"""
+
+hours = [1, 4, 8, 12, 24, 72, 168]
+categories = {
+    "dv": ["desktop", "mobile", "tablet"],
+    "br": ["chrome", "firefox", "safari", "edge", "opera"],
+    "os": ["windows", "macos", "linux", "android", "ios"],
+    "lc": ["en-US", "en-GB", "de-DE", "fr-FR", "es-ES", "pl-PL"],
+    "cc": ["US", "GB", "DE", "FR", "ES", "PL", "IT", "NL"],
+    "unique": ["0", "1"],
+}
+
+
+def generate_predictions(projects=1000, seed=0):
+    """Generate the model predictions in the format of `predict_future_data`"""
+    rng = random.Random(seed)
+    records = []
+    for pid in range(projects):
+        record = {"pid": f"project-{pid}"}
+        for hour in hours:
+            record[f"traffic_next_{hour}_hr"] = rng.uniform(0, 1000)
+            for category, fields in categories.items():
+                for field in fields:
+                    key = f"{category}_{field}_next_{hour}_hr"
+                    record[key] = rng.choice([0, rng.uniform(0, 100)])
+        records.append(record)
+    return json.dumps(records)
+
+
+def create_predictions_table(client, blobs):
+    columns = ", ".join(f"{timeframe} TEXT" for timeframe in timeframes)
+    if blobs:
+        columns += ", response BLOB, content_encoding TEXT"
+    client.execute_query(
+        f"CREATE TABLE predictions (pid TEXT PRIMARY KEY, {columns})"
+    )
+
+
+def write_columns(client, predictions):
+    """Current layout: the seven JSON columns"""
+    processed_data = serialise_predictions(json.loads(predictions))
+    data = [row[:-2] for row in serialise_data_for_sqlite(processed_data)]
+    client.insert_data("predictions", data, ["pid", *timeframes])
+
+
+def write_blobs(client, predictions, compress=False):
+    """New layout: the seven JSON columns and the pre-rendered response"""
+    processed_data = serialise_predictions(json.loads(predictions))
+    data = serialise_data_for_sqlite(processed_data, compress)
+    client.insert_data(
+        "predictions",
+        data,
+        ["pid", *timeframes, "response", "content_encoding"],
+    )
+
+
+def serve_columns(client, pid):
+    """Read the seven JSON columns and encode them the way FastAPI does"""
+    columns = ", ".join(timeframes)
+    result = client.execute_query(
+        f"SELECT {columns} FROM predictions WHERE pid = ?", (pid,)
+    )
+    predictions = {}
+    for timeframe, value in zip(timeframes, result[0]):
+        prediction_data = json.loads(value)
+        if prediction_data:
+            predictions[timeframe] = prediction_data
+    return JSONResponse(content=jsonable_encoder(predictions)).body
+
+
+def serve_blobs(client, pid):
+    """Read the pre-rendered response and send it as is"""
+    result = client.execute_query(
+        "SELECT response, content_encoding FROM predictions WHERE pid = ?",
+        (pid,),
+    )
+    return Response(content=result[0][0], media_type="application/json").body
+
+
+def timeit(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def run(projects=1000, requests=2000):
+    predictions = generate_predictions(projects)
+    pids = [f"project-{pid}" for pid in range(projects)]
+
+    layouts = [
+        ("columns", False, write_columns, serve_columns),
+        ("blobs", True, write_blobs, serve_blobs),
+        (
+            "blobs_gzip",
+            True,
+            lambda client, data: write_blobs(client, data, compress=True),
+            serve_blobs,
+        ),
+    ]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, blobs, write, serve in layouts:
+            client = SQLiteClient()
+            client.db_path = os.path.join(directory, f"{name}.db")
+            create_predictions_table(client, blobs)
+
+            def write_run():
+                client.drop_all_data_from_table("predictions")
+                write(client, predictions)
+
+            write_seconds = timeit(write_run, repeat=3)
+            serve_seconds = timeit(
+                lambda: [
+                    serve(client, pids[i % projects]) for i in range(requests)
+                ],
+                repeat=1,
+            )
+            results[name] = {
+                "write_seconds": write_seconds,
+                "serve_us_per_request": serve_seconds / requests * 1e6,
+                "db_bytes": os.path.getsize(client.db_path),
+            }
+
+    for name, result in results.items():
+        print(
+            f"{name:<12}"
+            f"write {result['write_seconds']:.3f}s  "
+            f"serve {result['serve_us_per_request']:.1f}us/request  "
+            f"size {result['db_bytes'] / 1024 ** 2:.1f}MB"
+        )
+    return results
+
+
+def run_serialisation(projects=1000):
+    df = pd.DataFrame(json.loads(generate_predictions(projects)))
+    pids = df["pid"].tolist()
+    next_hrs = df.columns.drop("pid").tolist()
+    y = df[next_hrs].to_numpy()
+
+    def serialise_json():
+        predictions = df.to_json(orient="records")
+        return serialise_predictions(json.loads(predictions))
+
+    def serialise_layout():
+        layout = build_target_layout(next_hrs, list(categories))
+        return serialise_prediction_array(pids, y, layout)
+
+    results = {
+        "json_regex_seconds": timeit(serialise_json, repeat=3),
+        "target_layout_seconds": timeit(serialise_layout, repeat=3),
+    }
+    print(
+        f"serialise   json+regex {results['json_regex_seconds']:.3f}s  "
+        f"target layout {results['target_layout_seconds']:.3f}s"
+    )
+    return results
+
+
+if __name__ == "__main__":
+    save_results(
+        "predictions_store",
+        {"layouts": run(), "serialisation": run_serialisation()},
+    )
@@ -0,0 +1,62 @@
+import os
+import json
+import time
+import platform
+import subprocess
+from datetime import datetime
+
+"""
+Results of the benchmarks are saved as JSON files named after the benchmark,
+the commit and the time, so regressions can be compared across commits:
+
+    benchmark_results/<benchmark>_<commit>_<YYYYmmdd_HHMMSS>.json
+"""
+
+results_directory = os.getenv("BENCHMARK_RESULTS_DIR", "benchmark_results/")
+
+
+def current_commit():
+    """Short hash of the checked out commit, ``unknown`` outside of git"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def timed(function, *args, **kwargs):
+    """Call the function and return its result and the wall time"""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def save_results(benchmark, results, config=None):
+    """Save the results of the benchmark and return the path of the file"""
+    commit = current_commit()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    os.makedirs(results_directory, exist_ok=True)
+    path = os.path.join(
+        results_directory, f"{benchmark}_{commit}_{timestamp}.json"
+    )
+
+    with open(path, "w") as file:
+        json.dump(
+            {
+                "benchmark": benchmark,
+                "commit": commit,
+                "created": datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "config": config or {},
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    return path
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+import pandas as pd
+from fastapi.testclient import TestClient
+from constants import date_col, agg_cols
+from data import load_data
+from data.serialisation import (
+    build_target_layout,
+    serialise_predictions,
+    serialise_prediction_array,
+)
+from models.train_model import train_model
+from models.predict_model import predict_future_data
+from sqlite.client import sqlite_client
+from sqlite.utils import (
+    save_model,
+    insert_predictions,
+    serialise_prediction_rows,
+    publish_prediction_rows,
+)
+from benchmarks.synthetic import generate_events
+from benchmarks.fake_clickhouse import fake_clickhouse
+from benchmarks.recording import timed, save_results
+
+"""
+Benchmark of every stage of the pipeline on synthetic analytics, with the
+``memory`` ingestion served by the local ClickHouse stand-in and a temporary
+SQLite database. The results are saved as JSON by ``benchmarks.recording``.
+
+    python -m benchmarks.stages --projects 20 --events-per-hour 50
+"""
+
+
+def create_sqlite_database(directory):
+    """Create the tables in a new database and use it for the benchmark"""
+    path = os.path.join(directory, "benchmark.db")
+    subprocess.run(
+        [sys.executable, "migrations_tables.py"],
+        cwd=os.path.join(os.path.dirname(__file__), "..", "sqlite"),
+        env={**os.environ, "SQLITE_DATABASE": path},
+        check=True,
+    )
+    sqlite_client.db_path = path
+    return path
+
+
+def shape(result):
+    """Rows and columns of the DataFrame of the stage result"""
+    if isinstance(result, tuple):
+        result = result[0]
+    if isinstance(result, pd.DataFrame):
+        return {"rows": len(result), "columns": len(result.columns)}
+    return {}
+
+
+def run_stages(config, directory, requests=1000):
+    results = {}
+
+    def record(stage, function, *args, **kwargs):
+        result, seconds = timed(function, *args, **kwargs)
+        results[stage] = {"seconds": seconds, **shape(result)}
+        print(f"{stage:<45}{seconds:8.3f}s")
+        return result
+
+    events = generate_events(**config)
+    database = create_sqlite_database(directory)
+
+    with fake_clickhouse(events):
+        df = record("read_data_csv", load_data.read_data_csv)
+
+        df = load_data.sort_df_by_date_col(date_col, df)
+        df = load_data.convert_df_to_datetime(df)
+        df = load_data.filter_df_by_specific_date(df, time_delta_years=1)
+        df = load_data.filter_df_with_most_frequent_pid(df, None)
+        df = load_data.replace_null_values(df)
+        df, cat_features = load_data.categorize_features(df)
+        df = load_data.extract_date_components(df, date_col)
+        df = load_data.add_traffic_table(df)
+        df = load_data.convert_cat_features_to_dummies(df, cat_features)
+
+        df = record(
+            "combine_all_pids",
+            load_data.combine_all_pids,
+            df,
+            date_col,
+            agg_cols,
+        )
+        target_columns = load_data.set_target_columns(df)
+        df = load_data.remove_date_col(df)
+        df, cols = load_data.get_cols_withohut_pid(df)
+        df, next_hrs = record(
+            "create_target_traffic_by_target_columns",
+            load_data.create_target_traffic_by_target_columns,
+            df,
+            target_columns,
+        )
+        df = df.dropna()
+
+        model = record("train_model", train_model, df, cols, next_hrs)
+        model_path = save_model(model, directory, "model.joblib")
+        shard = {
+            "cat_features": cat_features,
+            "cols": list(cols),
+            "next_hrs": next_hrs,
+            "model_path": model_path,
+            "pids": None,
+        }
+        pids, y, _ = record(
+            "predict_future_data", predict_future_data, shard=shard
+        )
+
+    predictions = pd.DataFrame(y, columns=next_hrs)
+    predictions.insert(0, "pid", pids)
+    predictions = predictions.to_json(orient="records")
+    layout = build_target_layout(next_hrs, cat_features)
+
+    record(
+        "serialise_predictions", serialise_predictions, json.loads(predictions)
+    )
+    record(
+        "serialise_prediction_array",
+        serialise_prediction_array,
+        pids,
+        y,
+        layout,
+    )
+    record("insert_predictions", insert_predictions, predictions)
+    record(
+        "publish_prediction_rows",
+        lambda: publish_prediction_rows(
+            serialise_prediction_rows(pids, y, layout)
+        ),
+    )
+
+    import app
+
+    app.sqlite_client.db_path = database
+    client = TestClient(app.app)
+
+    def get_predictions(cached):
+        for request in range(requests):
+            if not cached:
+                app.predictions_cache.clear()
+            client.get("/predict/", params={"pid": pids[request % len(pids)]})
+
+    for cached in [False, True]:
+        stage = f"get_predictions_{'cached' if cached else 'uncached'}"
+        _, seconds = timed(get_predictions, cached)
+        results[stage] = {
+            "seconds": seconds,
+            "requests": requests,
+            "us_per_request": seconds / requests * 1e6,
+        }
+        print(f"{stage:<45}{seconds / requests * 1e6:8.1f}us/request")
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--projects", type=int, default=20)
+    parser.add_argument("--events-per-hour", type=int, default=50)
+    # Must exceed the longest horizon of 168 hours to leave training rows
+    parser.add_argument("--hours", type=int, default=24 * 14)
+    parser.add_argument("--cardinality", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--requests", type=int, default=1000)
+    args = parser.parse_args()
+
+    config = {
+        "projects": args.projects,
+        "events_per_hour": args.events_per_hour,
+        "hours": args.hours,
+        "cardinality": args.cardinality,
+        "seed": args.seed,
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        results = run_stages(config, directory, args.requests)
+    path = save_results(
+        "stages", results, {**config, "requests": args.requests}
+    )
+    print(f"Results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
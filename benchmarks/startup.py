@@ -0,0 +1,101 @@
+import sys
+import argparse
+import subprocess
+from benchmarks.recording import save_results
+
+"""
+Benchmark of the startup of the API and the Celery worker, measured with
+``python -X importtime``. The API only serves the stored predictions, so it
+fails as a regression check when it imports one of ``heavy_modules``.
+
+    python -m benchmarks.startup --repeat 5
+"""
+
+entrypoints = {
+    "api": "app",
+    "worker": "celery_tasks.tasks",
+}
+
+# Modules which the API process must not import
+heavy_modules = [
+    "pandas",
+    "numpy",
+    "sklearn",
+    "joblib",
+    "clickhouse_connect",
+    "scripts.run_training",
+    "scripts.run_prediction",
+]
+
+
+def measure_import(module):
+    """
+    Import the module in a fresh interpreter, return the total import time in
+    seconds, the cumulative import time of the direct imports of the top level
+    modules and every imported module
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+
+    total = 0.0
+    imports = {}
+    modules = set()
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        modules.add(name.strip())
+        # Nested imports are indented by two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            total += int(cumulative) / 1e6
+        elif depth == 1:
+            imports[name.strip()] = int(cumulative) / 1e6
+    return total, imports, modules
+
+
+def run(repeat):
+    results = {}
+    failures = []
+    for entrypoint, module in entrypoints.items():
+        timings = []
+        for _ in range(repeat):
+            total, imports, modules = measure_import(module)
+            timings.append(total)
+
+        slowest = sorted(imports.items(), key=lambda item: -item[1])[:10]
+        results[entrypoint] = {
+            "module": module,
+            "import_seconds": min(timings),
+            "modules": len(modules),
+            "slowest": dict(slowest),
+        }
+        print(
+            f"{entrypoint:<8}{min(timings):>8.3f}s"
+            f"{len(modules):>6} modules  ({module})"
+        )
+        for name, seconds in slowest:
+            print(f"    {name:<40}{seconds:>8.3f}s")
+
+        if entrypoint == "api":
+            imported = [name for name in heavy_modules if name in modules]
+            results[entrypoint]["heavy_modules"] = imported
+            failures.extend(imported)
+
+    path = save_results("startup", results, {"repeat": repeat})
+    print(f"Saved results to {path}")
+
+    if failures:
+        print(f"The API imports {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.repeat)
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+from constants import columns, date_col
+
+"""
+Seeded generator of synthetic analytics events in the ``constants.columns``
+schema, so the pipeline can be measured without a live ClickHouse.
+"""
+
+
+def category_values(col, cardinality):
+    """Values of the categorical column, ``dv`` and ``unique`` are fixed"""
+    if col == "dv":
+        return ["desktop", "mobile", "tablet"]
+    if col == "unique":
+        return [0, 1]
+    return [f"{col}-{value}" for value in range(cardinality)]
+
+
+def generate_events(
+    projects=20,
+    events_per_hour=50,
+    hours=24 * 14,
+    cardinality=20,
+    null_share=0.05,
+    end=pd.Timestamp("2024-07-01"),
+    seed=0,
+):
+    """
+    Generate the events of ``projects`` over the last ``hours`` before
+    ``end``. The traffic of the projects follows a Zipf distribution, so a few
+    projects get most of the events, as in the analytics.
+
+    Parameters:
+    projects (int): Amount of projects.
+    events_per_hour (int): Mean amount of events per project and hour.
+    hours (int): Amount of hours.
+    cardinality (int): Amount of values of ``br``, ``os``, ``lc``, ``cc`` and
+                       of the other string columns.
+    null_share (float): Share of missing values of the categorical columns.
+    seed (int): Seed of the random generator.
+
+    Returns:
+    pd.DataFrame: The events with ``constants.columns``.
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, projects + 1)
+    weights = weights / weights.sum()
+    size = rng.poisson(events_per_hour * projects * hours)
+
+    start = end - pd.Timedelta(hours=hours)
+    offsets = np.sort(rng.integers(0, hours * 3600, size))
+    pids = np.array([f"pid{pid:09d}" for pid in range(projects)])
+
+    df = pd.DataFrame(
+        {
+            "psid": rng.integers(0, 2**32, size).astype(str),
+            "sid": rng.integers(0, 2**32, size).astype(str),
+            "pid": pids[rng.choice(projects, size, p=weights)],
+            date_col: start + pd.to_timedelta(offsets, unit="s"),
+            "sdur": rng.integers(0, 3600, size),
+            "meta.key": [[] for _ in range(size)],
+            "meta.value": [[] for _ in range(size)],
+        }
+    )
+    for col in ["dv", "br", "os", "lc", "cc", "unique"]:
+        values = np.array(category_values(col, cardinality), dtype=object)
+        df[col] = values[rng.zipf(1.5, size) % len(values)]
+        if col != "unique":
+            df.loc[rng.random(size) < null_share, col] = None
+    for col in ["pg", "prev", "ref", "so", "me", "ca", "rg", "ct"]:
+        values = np.array(category_values(col, cardinality), dtype=object)
+        df[col] = values[rng.integers(0, len(values), size)]
+
+    return df[list(columns)]
@@ -0,0 +1,86 @@
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+import pandas as pd
+from models.train_model import train_model
+from utils.instrumentation import peak_rss_mb
+from benchmarks.recording import save_results
+
+"""
+Benchmark of the single model against the per pid models trained on a pool of
+processes. Every mode runs in its own process, so the peak memory of one does
+not hide the other.
+
+    python -m benchmarks.training
+"""
+
+hours = [1, 4, 8, 12, 24, 72, 168]
+
+
+def generate_training_data(projects=15, rows=2000, features=40, seed=0):
+    """Generate a training frame in the format of ``pre_process_data``"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "pid": np.repeat([f"project-{i}" for i in range(projects)], rows),
+            "year": 2024,
+            "month": rng.integers(1, 13, projects * rows),
+            "day": rng.integers(1, 29, projects * rows),
+            "day_of_week": rng.integers(0, 7, projects * rows),
+            "hour": rng.integers(0, 24, projects * rows),
+        }
+    )
+    counts = rng.poisson(5, (projects * rows, features))
+    names = [f"cat_{i}" for i in range(features)]
+    df[names] = counts
+    cols = df.columns.drop("pid")
+
+    next_hrs = []
+    for hour in hours:
+        targets = [f"{name}_next_{hour}_hr" for name in names]
+        df[targets] = np.roll(counts, -hour, axis=0).astype(float)
+        next_hrs += targets
+    return df, cols, next_hrs
+
+
+def run_mode(mode):
+    df, cols, next_hrs = generate_training_data()
+    start = time.perf_counter()
+    train_model(df, cols, next_hrs, per_pid=mode == "per_pid")
+    # Every mode runs in its own process, so the peaks are of the mode only
+    own, children = peak_rss_mb()
+    return {
+        "seconds": time.perf_counter() - start,
+        "peak_memory_mb": own,
+        "peak_worker_memory_mb": children,
+    }
+
+
+def run():
+    results = {}
+    for mode in ["single", "per_pid"]:
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.training", mode],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results[mode] = json.loads(output.splitlines()[-1])
+
+    for mode, result in results.items():
+        print(
+            f"{mode:<8}"
+            f"{result['seconds']:.1f}s  "
+            f"peak {result['peak_memory_mb']:.0f}MB  "
+            f"largest worker {result['peak_worker_memory_mb']:.0f}MB"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        print(json.dumps(run_mode(sys.argv[1])))
+    else:
+        save_results("training", run())
@@ -1,4 +1,5 @@
 from celery import Celery
+from celery.schedules import crontab
 import os
 from dotenv import load_dotenv
 
@@ -7,6 +8,9 @@ celery_app = Celery(
     "swetrix-ai-celery",
     broker=os.getenv("REDIS_BROKER"),
     backend=os.getenv("REDIS_BACKEND"),
+    # The tasks import the ML stack, so only the worker imports them, the API
+    # enqueues them by name with ``send_task``
+    include=["celery_tasks.tasks"],
 )
 
 celery_app.conf.update(
@@ -16,8 +20,22 @@ celery_app.conf.update(
     accept_content=["json"],
     task_soft_time_limit=3600,  # 1 hour soft time limit
     task_time_limit=3700,  # 1 hour 10 minutes hard time limit
+    # Run the tasks in the calling process, e.g. with a ``memory://`` broker
+    task_always_eager=os.getenv("CELERY_TASK_ALWAYS_EAGER", "false") == "true",
+    # Run by ``celery beat`` (or a worker started with ``--beat``), the runs
+    # are single-flight, so a tick during a running run is skipped
+    beat_schedule={
+        "run-prediction": {
+            "task": "celery_tasks.tasks.run_prediction_module",
+            "schedule": crontab(
+                minute=os.getenv("PREDICTION_SCHEDULE_MINUTE", "5")
+            ),
+        },
+        "run-training": {
+            "task": "celery_tasks.tasks.run_training_module",
+            "schedule": crontab(
+                minute=0, hour=os.getenv("TRAINING_SCHEDULE_HOUR", "3")
+            ),
+        },
+    },
 )
-
-from celery_tasks.tasks import *
-
-# celery_app.autodiscover_tasks(['celery_tasks'])
@@ -1,13 +1,117 @@
+import os
+from celery import chord
 from celery_tasks.celery_config import celery_app
-from scripts.run_training import train
-from scripts.run_prediction import predict
+from scripts.run_training import (
+    train,
+    train_shard,
+    plan_training_shards,
+    publish_training,
+)
+from scripts.run_prediction import (
+    predict_shard,
+    publish_predictions,
+)
+from models.predict_model import get_training_shards
+from sqlite.task_locks import (
+    acquire_task_lock,
+    release_task_lock,
+    set_task_shards,
+)
+from logging_config import setup_logger
+
+logger = setup_logger("celery_tasks")
+
+
+@celery_app.task
+def run_training_module(run_id=None):
+    """
+    Train the most frequent projects, or fan out over shards of every project
+    when ``TRAINING_SHARD_SIZE`` is set. Without the ``run_id`` of the lock
+    taken by the trigger, e.g. when scheduled by beat, the task takes the lock
+    itself and is skipped while another training is running.
+    """
+    run_id = run_id or acquire_task_lock("training")
+    if run_id is None:
+        logger.info("Training is already running, skipping")
+        return
+
+    try:
+        shard_size = int(os.getenv("TRAINING_SHARD_SIZE", 0))
+        if not shard_size:
+            set_task_shards("training", run_id, 1)
+            train()
+            release_task_lock("training", run_id)
+            return
+
+        shards = plan_training_shards(shard_size)
+        set_task_shards("training", run_id, len(shards))
+        chord(
+            train_shard_module.s(pids, shard)
+            for shard, pids in enumerate(shards)
+        )(
+            publish_training_module.s(run_id).on_error(
+                release_task_lock_module.si("training", run_id)
+            )
+        )
+    except BaseException:
+        release_task_lock("training", run_id)
+        raise
+
+
+@celery_app.task
+def train_shard_module(pids, shard):
+    return train_shard(pids, shard)
+
+
+@celery_app.task
+def publish_training_module(shards, run_id=None):
+    try:
+        publish_training(shards)
+    finally:
+        release_task_lock("training", run_id)
+
+
+@celery_app.task
+def run_prediction_module(run_id=None):
+    """
+    Predict every trained shard on its own worker and publish them, skipped
+    while another prediction is running
+    """
+    run_id = run_id or acquire_task_lock("prediction")
+    if run_id is None:
+        logger.info("Prediction is already running, skipping")
+        return
+
+    try:
+        shards = get_training_shards()
+        set_task_shards("prediction", run_id, len(shards))
+        chord(
+            predict_shard_module.s(shard, index)
+            for index, shard in enumerate(shards)
+        )(
+            publish_predictions_module.s(
+                run_id, [shard["model_path"] for shard in shards]
+            ).on_error(release_task_lock_module.si("prediction", run_id))
+        )
+    except BaseException:
+        release_task_lock("prediction", run_id)
+        raise
+
+
+@celery_app.task
+def predict_shard_module(shard, index):
+    return predict_shard(shard, index)
 
 
 @celery_app.task
-def run_training_module():
-    train()
+def publish_predictions_module(paths, run_id, model_paths):
+    try:
+        publish_predictions(paths, model_paths)
+    finally:
+        release_task_lock("prediction", run_id)
 
 
 @celery_app.task
-def run_prediction_module():
-    predict()
+def release_task_lock_module(task, run_id):
+    """Release the lock of a run whose shards failed"""
+    release_task_lock(task, run_id)
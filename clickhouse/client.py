@@ -1,8 +1,33 @@
 import os
+import pandas as pd
+import pyarrow as pa
 from dotenv import load_dotenv
 from clickhouse_connect import get_client
 
 
+def arrow_to_frame(table):
+    """
+    Convert the Arrow table of a query to a DataFrame without a Python object
+    per cell: dictionaries become categoricals, strings stay backed by Arrow
+    and timestamps become naive ``datetime64[ns]``.
+
+    ClickHouse tags the timestamps with the timezone of the column, or of the
+    server, which is also the timezone of ``toHour`` and the other date
+    functions of the queries. Keep the local time of that timezone so the
+    date components of the training and the prediction data match.
+    """
+    df = table.to_pandas(
+        types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get,
+        coerce_temporal_nanoseconds=True,
+    )
+    # Dictionaries of LowCardinality columns may hold values of other rows
+    for col in df.select_dtypes("category").columns:
+        df[col] = df[col].cat.remove_unused_categories()
+    for col in df.select_dtypes("datetimetz").columns:
+        df[col] = df[col].dt.tz_localize(None)
+    return df
+
+
 class ClickHouseClient:
     def __init__(self):
         load_dotenv()
@@ -11,17 +36,53 @@ class ClickHouseClient:
         self.user = os.getenv("CLICKHOUSE_USER")
         self.password = os.getenv("CLICKHOUSE_PASSWORD")
         self.database = os.getenv("CLICKHOUSE_DATABASE")
+        self._client = None
+
+    @property
+    def client(self):
+        """The connection is opened by the first query, not on import"""
+        if self._client is None:
+            self._client = get_client(
+                host=self.host,
+                port=self.port,
+                user=self.user,
+                password=self.password,
+                database=self.database,
+            )
+        return self._client
+
+    def execute_query(self, query: str, parameters: dict = None):
+        return self.client.query(query, parameters=parameters)
 
-        self.client = get_client(
-            host=self.host,
-            port=self.port,
-            user=self.user,
-            password=self.password,
-            database=self.database,
+    def query_frame(self, query: str, parameters: dict = None):
+        """Query the result as a DataFrame through the Arrow format
+
+        ClickHouse sends ``LowCardinality`` columns as dictionaries and
+        ``DateTime`` columns as ``UInt32`` in Arrow, so select the timestamps
+        with ``toDateTime64(col, 0)``. See ``arrow_to_frame``.
+        """
+        table = self.client.query_arrow(
+            query,
+            parameters=parameters,
+            settings={"output_format_arrow_low_cardinality_as_dictionary": 1},
         )
+        return arrow_to_frame(table)
+
+    def execute_command(self, query: str, parameters: dict = None):
+        return self.client.command(query, parameters=parameters)
 
-    def execute_query(self, query: str):
-        return self.client.query(query)
+    def stream_query(
+        self, query: str, parameters: dict = None, block_size: int = None
+    ):
+        """Stream the query result as blocks of rows instead of loading it at once
+
+        Use it as a context manager, every iteration yields a list of row tuples
+        containing at most ``block_size`` rows.
+        """
+        settings = {"max_block_size": block_size} if block_size else None
+        return self.client.query_row_block_stream(
+            query, parameters=parameters, settings=settings
+        )
 
     def insert_data(self, table: str, data: list, column_names: list):
         self.client.insert(table=table, data=data, column_names=column_names)
@@ -0,0 +1,53 @@
+from clickhouse.client import clickhouse_client
+from constants import date_col, rollup_table
+from data.aggregation import events_to_long_format
+
+
+def create_tables():
+    """
+    Create the ``analytics_hourly`` rollup table with the materialized view
+    maintaining it, and backfill it with the existing analytics.
+
+    The materialized view is created first and counts every inserted event,
+    the backfill then counts the events created before the view, so only the
+    events inserted during the backfill with an older ``created`` timestamp
+    may be counted twice.
+    """
+    exists = clickhouse_client.execute_query(f"EXISTS TABLE {rollup_table}")
+    if exists.result_rows[0][0]:
+        return
+
+    rollup_query = f"""
+    CREATE TABLE IF NOT EXISTS {rollup_table} (
+        pid String,
+        hour DateTime,
+        category LowCardinality(String),
+        value String,
+        events UInt64,
+        first_created SimpleAggregateFunction(min, DateTime),
+        last_created SimpleAggregateFunction(max, DateTime)
+    )
+    ENGINE = SummingMergeTree
+    ORDER BY (pid, hour, category, value)
+    """
+
+    view_query = f"""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS {rollup_table}_mv
+    TO {rollup_table}
+    AS {events_to_long_format("1")}
+    """
+
+    clickhouse_client.execute_command(rollup_query)
+    clickhouse_client.execute_command(view_query)
+
+    now = clickhouse_client.execute_query("SELECT now()").result_rows[0][0]
+    boundary = now.strftime("%Y-%m-%d %H:%M:%S")
+    backfill_query = f"""
+    INSERT INTO {rollup_table}
+    {events_to_long_format(f"{date_col} < '{boundary}'")}
+    """
+    clickhouse_client.execute_command(backfill_query)
+
+
+if __name__ == "__main__":
+    create_tables()
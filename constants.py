@@ -23,3 +23,11 @@ columns = (
 )
 agg_cols = ["year", "month", "day", "day_of_week", "hour", "pid"]
 date_col = "created"
+# Columns which are one-hot encoded and used as the features / targets
+cat_columns = ["dv", "br", "os", "lc", "cc", "unique"]
+# String columns with few distinct values, read from ClickHouse as dictionaries
+dictionary_columns = ["pid", "dv", "br", "os", "lc", "cc"]
+# Amount of rows read from ClickHouse per block in the streaming ingestion
+stream_block_size = 100_000
+# ClickHouse rollup table with the hourly traffic per pid and category value
+rollup_table = "analytics_hourly"
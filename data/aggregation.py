@@ -0,0 +1,424 @@
+import pandas as pd
+from clickhouse.client import clickhouse_client
+from constants import agg_cols, cat_columns, date_col, rollup_table
+from data.vocabulary import other_value, category_values
+from logging_config import setup_logger
+
+logger = setup_logger("aggregation")
+
+"""
+Hourly aggregation of the analytics inside ClickHouse.
+
+Instead of one-hot encoding every event in pandas, the hourly ``traffic`` and
+the per-category counts are calculated by ClickHouse, so Python receives one
+row per (pid, hour). The counts are either calculated from the ``analytics``
+table directly, or from the ``analytics_hourly`` rollup table maintained by a
+materialized view (see ``clickhouse/migrations_tables.py``).
+
+The rollup table stores the counts in a long format: one row per pid, hour,
+category and value, where the ``traffic`` category counts all events.
+"""
+
+date_parts = """
+    toYear(hour) AS year,
+    toMonth(hour) AS month,
+    toDayOfMonth(hour) AS day,
+    toDayOfWeek(hour) - 1 AS day_of_week,
+    toHour(hour) AS hour_of_day
+"""
+
+
+def events_to_long_format(where):
+    """
+    Return the query converting analytics events into the long format of the
+    rollup table, it is used by the materialized view as well.
+
+    Parameters:
+    where (str): Condition to filter the events with.
+
+    Returns:
+    str: The query.
+    """
+    pairs = ", ".join(f"('{col}', toString(`{col}`))" for col in cat_columns)
+    return f"""
+    SELECT
+        pid,
+        toStartOfHour({date_col}) AS hour,
+        pair.1 AS category,
+        assumeNotNull(pair.2) AS value,
+        count() AS events,
+        min({date_col}) AS first_created,
+        max({date_col}) AS last_created
+    FROM analytics
+    ARRAY JOIN [('traffic', ''), {pairs}] AS pair
+    WHERE ({where}) AND pair.2 IS NOT NULL AND pair.2 != '\\\\N'
+    GROUP BY pid, hour, category, value
+    """
+
+
+def rollup_window(with_pids=True, with_end=False):
+    """
+    Return the query reading the rollup table since ``start_date``, the hour of
+    ``start_date`` is read from the analytics table to cut it at the exact time.
+    With ``with_end`` the hours are read until the hour aligned ``end_date``.
+    """
+    pids_filter = "AND pid IN %(pids)s" if with_pids else ""
+    end_filter = "AND {} < %(end_date)s" if with_end else ""
+    boundary = events_to_long_format(
+        f"""
+        {date_col} >= %(start_date)s
+        AND {date_col} < toStartOfHour(toDateTime(%(start_date)s))
+            + INTERVAL 1 HOUR
+        {pids_filter}
+        {end_filter.format(date_col)}
+        """
+    )
+    return f"""
+    SELECT pid, hour, category, value, events, first_created, last_created
+    FROM {rollup_table}
+    WHERE hour > toStartOfHour(toDateTime(%(start_date)s))
+        {pids_filter}
+        {end_filter.format("hour")}
+    UNION ALL
+    {boundary}
+    """
+
+
+def get_max_created(rollup=False):
+    """Return the most recent ``created`` timestamp of the analytics"""
+    if rollup:
+        query = f"SELECT max(last_created) FROM {rollup_table}"
+    else:
+        query = f"SELECT max({date_col}) FROM analytics"
+    data = clickhouse_client.execute_query(query)
+    return pd.Timestamp(data.result_rows[0][0])
+
+
+def get_most_frequent_pids(start_date, project_amount=15, rollup=False):
+    """
+    Return the pids with the most events since ``start_date``, all of the pids
+    are returned if ``project_amount`` is ``None``.
+    """
+    limit = "LIMIT %(project_amount)s" if project_amount is not None else ""
+    if rollup:
+        query = f"""
+        SELECT pid
+        FROM ({rollup_window(with_pids=False)})
+        WHERE category = 'traffic'
+        GROUP BY pid
+        ORDER BY sum(events) DESC, pid
+        {limit}
+        """
+    else:
+        query = f"""
+        SELECT pid
+        FROM analytics
+        WHERE {date_col} >= %(start_date)s
+        GROUP BY pid
+        ORDER BY count() DESC, pid
+        {limit}
+        """
+    data = clickhouse_client.execute_query(
+        query,
+        parameters={
+            "start_date": start_date.to_pydatetime(),
+            "project_amount": project_amount,
+        },
+    )
+    return [row[0] for row in data.result_rows]
+
+
+def get_cat_values(
+    start_date, pids, threshold=300, rollup=False, end_date=None
+):
+    """
+    Collect the values of the categorical columns, at most ``threshold + 1``
+    values are collected per column, which is enough to tell if the column
+    exceeds the ``threshold``. All values are collected if ``threshold`` is
+    ``None``.
+
+    Parameters:
+    start_date (pd.Timestamp): The earliest ``created`` timestamp to read.
+    pids (list): The pids to read the values for.
+    threshold (int): The maximum number of unique values of a feature.
+    rollup (bool): Read the values from the rollup table.
+    end_date (pd.Timestamp): The hour aligned timestamp to read the values
+                             until, everything is read if it is ``None``.
+
+    Returns:
+    dict: Sorted values of every categorical column.
+    """
+    limit = f"({threshold + 1})" if threshold is not None else ""
+    parameters = {
+        "start_date": start_date.to_pydatetime(),
+        "pids": tuple(pids),
+    }
+    if end_date is not None:
+        parameters["end_date"] = end_date.to_pydatetime()
+
+    if rollup:
+        query = f"""
+        SELECT category, groupUniqArray{limit}(value)
+        FROM ({rollup_window(with_end=end_date is not None)})
+        WHERE category != 'traffic'
+        GROUP BY category
+        """
+        data = clickhouse_client.execute_query(query, parameters=parameters)
+        values = dict(data.result_rows)
+    else:
+        uniques = ", ".join(
+            f"groupUniqArrayIf{limit}"
+            f"(toString(`{col}`), toString(`{col}`) != '\\\\N')"
+            for col in cat_columns
+        )
+        end_filter = (
+            f"AND {date_col} < %(end_date)s" if end_date is not None else ""
+        )
+        query = f"""
+        SELECT {uniques}
+        FROM analytics
+        WHERE {date_col} >= %(start_date)s AND pid IN %(pids)s {end_filter}
+        """
+        data = clickhouse_client.execute_query(query, parameters=parameters)
+        values = dict(zip(cat_columns, data.result_rows[0]))
+
+    return {col: sorted(values.get(col, [])) for col in cat_columns}
+
+
+def get_top_values(start_date, pids, size, rollup=False, end_date=None):
+    """
+    Collect the ``size`` most frequent values of every categorical column, the
+    ties are broken by the value, as ``vocabulary.fit_vocabularies`` does.
+
+    Parameters:
+    start_date (pd.Timestamp): The earliest ``created`` timestamp to read.
+    pids (list): The pids to read the values for.
+    size (int): The maximum amount of values per column.
+    rollup (bool): Read the values from the rollup table.
+    end_date (pd.Timestamp): The hour aligned timestamp to read the values
+                             until, everything is read if it is ``None``.
+
+    Returns:
+    dict: The most frequent values of every categorical column.
+    """
+    parameters = {
+        "start_date": start_date.to_pydatetime(),
+        "pids": tuple(pids),
+        "size": size,
+    }
+    if end_date is not None:
+        parameters["end_date"] = end_date.to_pydatetime()
+
+    if rollup:
+        source = rollup_window(with_end=end_date is not None)
+    else:
+        end_filter = (
+            f"AND {date_col} < %(end_date)s" if end_date is not None else ""
+        )
+        source = events_to_long_format(
+            f"{date_col} >= %(start_date)s AND pid IN %(pids)s {end_filter}"
+        )
+    query = f"""
+    SELECT category, value
+    FROM ({source})
+    WHERE category != 'traffic'
+    GROUP BY category, value
+    ORDER BY sum(events) DESC, value
+    LIMIT %(size)s BY category
+    """
+    data = clickhouse_client.execute_query(query, parameters=parameters)
+
+    values = {col: [] for col in cat_columns}
+    for category, value in data.result_rows:
+        values[category].append(value)
+    return values
+
+
+def count_columns(cat_values, rollup=False):
+    """
+    Return the conditional counts of ``traffic`` and every category value, which
+    are named as the ``pd.get_dummies`` columns, with their query parameters.
+    The ``__other__`` value counts every value of the category which is not
+    counted by the others.
+    """
+    names = ["traffic"]
+    if rollup:
+        counts = ["sumIf(events, category = 'traffic')"]
+    else:
+        counts = ["count()"]
+
+    parameters = {}
+    for col, values in cat_values.items():
+        for i, value in enumerate(values):
+            param = f"{col}_{i}"
+            names.append(f"{col}_{value}")
+            if value == other_value:
+                # Every value of the category, except of the counted ones
+                known = tuple(
+                    counted for counted in values if counted != other_value
+                )
+                parameters[param] = known
+                if rollup:
+                    condition = f"category = '{col}'"
+                    if known:
+                        condition += f" AND value NOT IN %({param})s"
+                    counts.append(f"sumIf(events, {condition})")
+                else:
+                    condition = f"toString(`{col}`) != '\\\\N'"
+                    if known:
+                        condition += (
+                            f" AND toString(`{col}`) NOT IN %({param})s"
+                        )
+                    counts.append(f"countIf({condition})")
+                continue
+
+            parameters[param] = value
+            if rollup:
+                counts.append(
+                    f"sumIf(events, category = '{col}'"
+                    f" AND value = %({param})s)"
+                )
+            else:
+                counts.append(f"countIf(toString(`{col}`) = %({param})s)")
+
+    return names, counts, parameters
+
+
+def query_hourly_traffic(
+    start_date, pids, cat_values, rollup=False, end_date=None
+):
+    """
+    Aggregate the traffic of ``pids`` since ``start_date`` by pid and hour.
+
+    Parameters:
+    start_date (pd.Timestamp): The earliest ``created`` timestamp to read.
+    pids (list): The pids to aggregate the traffic for.
+    cat_values (dict): Values of every categorical feature to count.
+    rollup (bool): Read the counts from the rollup table.
+    end_date (pd.Timestamp): The hour aligned timestamp to read the traffic
+                             until, everything is read if it is ``None``.
+
+    Returns:
+    pd.DataFrame: One row per pid and hour with ``agg_cols``, the counted
+                  columns and the first (``min``) and last (``max``) event.
+    """
+    names, counts, parameters = count_columns(cat_values, rollup)
+    if end_date is not None:
+        parameters["end_date"] = end_date.to_pydatetime()
+
+    if rollup:
+        source = f"({rollup_window(with_end=end_date is not None)})"
+        group_by = "hour"
+        first, last = "min(first_created)", "max(last_created)"
+    else:
+        source = (
+            f"analytics WHERE {date_col} >= %(start_date)s"
+            " AND pid IN %(pids)s"
+        )
+        if end_date is not None:
+            source += f" AND {date_col} < %(end_date)s"
+        group_by = f"toStartOfHour({date_col}) AS hour"
+        first, last = f"min({date_col})", f"max({date_col})"
+
+    query = f"""
+    SELECT
+        {date_parts},
+        pid,
+        {", ".join(counts)},
+        {first},
+        {last}
+    FROM {source}
+    GROUP BY pid, {group_by}
+    """
+    data = clickhouse_client.execute_query(
+        query,
+        parameters={
+            "start_date": start_date.to_pydatetime(),
+            "pids": tuple(pids),
+            **parameters,
+        },
+    )
+    return pd.DataFrame(
+        data.result_rows, columns=[*agg_cols, *names, "min", "max"]
+    )
+
+
+def split_hourly_traffic(df):
+    """
+    Split the hourly traffic returned by ``query_hourly_traffic`` into the
+    traffic indexed by ``agg_cols`` and the first and last event of every pid.
+    """
+    names = [col for col in df.columns if col not in [*agg_cols, "min", "max"]]
+
+    bounds = df.groupby("pid").agg({"min": "min", "max": "max"})
+    # Keep the pids in the order of their first event, as ``df.pid.unique()``
+    bounds = bounds.sort_values("min", kind="stable")
+
+    traffic = df.set_index(agg_cols)[names].astype("int64")
+    return traffic, bounds
+
+
+def aggregate_hourly_traffic(start_date, pids, cat_values, rollup=False):
+    """
+    Aggregate the traffic of ``pids`` since ``start_date`` by pid and hour.
+
+    Parameters:
+    start_date (pd.Timestamp): The earliest ``created`` timestamp to read.
+    pids (list): The pids to aggregate the traffic for.
+    cat_values (dict): Values of every categorical feature to count.
+    rollup (bool): Read the counts from the rollup table.
+
+    Returns:
+    pd.DataFrame: The traffic of all pids indexed by ``agg_cols``.
+    pd.DataFrame: The first and last event of every pid.
+    """
+    df = query_hourly_traffic(start_date, pids, cat_values, rollup)
+    return split_hourly_traffic(df)
+
+
+def aggregate_latest_hour(cat_features, cols, rollup=False, pids=None):
+    """
+    Aggregate the traffic of every pid in the most recent hour of analytics.
+
+    Parameters:
+    cat_features (list): Categorical features the model was trained with.
+    cols (list): Feature columns the model was trained with.
+    rollup (bool): Read the counts from the rollup table.
+    pids (list): Only aggregate these pids, all of them if ``None``.
+
+    Returns:
+    pd.DataFrame: One row per pid with ``agg_cols`` and the counted columns.
+    """
+    cat_values = category_values(cols, cat_features)
+    names, counts, parameters = count_columns(cat_values, rollup)
+    pid_filter = " AND pid IN %(pids)s" if pids is not None else ""
+    if rollup:
+        source = f"{rollup_table} WHERE hour = %(hour)s{pid_filter}"
+        group_by = "hour"
+    else:
+        source = (
+            f"analytics WHERE {date_col} >= %(hour)s"
+            f" AND {date_col} < toDateTime(%(hour)s) + INTERVAL 1 HOUR"
+            f"{pid_filter}"
+        )
+        group_by = f"toStartOfHour({date_col}) AS hour"
+
+    query = f"""
+    SELECT
+        {date_parts},
+        pid,
+        {", ".join(counts)}
+    FROM {source}
+    GROUP BY pid, {group_by}
+    ORDER BY pid
+    """
+    hour = get_max_created(rollup).floor("h")
+    data = clickhouse_client.execute_query(
+        query,
+        parameters={
+            "hour": hour.to_pydatetime(),
+            "pids": tuple(pids) if pids is not None else None,
+            **parameters,
+        },
+    )
+    return pd.DataFrame(data.result_rows, columns=[*agg_cols, *names])
@@ -0,0 +1,180 @@
+import json
+import numpy as np
+import pandas as pd
+from constants import agg_cols
+from data.vocabulary import (
+    other_value,
+    fit_vocabularies,
+    category_values,
+)
+
+"""
+Feature pipeline shared by the training and the predictions.
+
+The pipeline maps raw analytics events straight into a NumPy matrix with one
+row per pid and hour, laid out in the column order of the training: the date
+components, the ``traffic`` and the count of every value of every categorical
+feature (named as the ``pd.get_dummies`` columns). Null values (``None``,
+``NaN`` and ``\\N``) are not counted, values outside of the fitted ones are
+counted by the ``__other__`` column of their feature if the pipeline has one,
+otherwise they are ignored.
+
+The pipeline is fitted by the training and saved as JSON next to the model,
+so the predictions encode the events exactly the same way.
+"""
+
+date_features = [col for col in agg_cols if col != "pid"]
+
+
+class FeaturePipeline:
+    def __init__(self, cat_features, values, columns=None):
+        """
+        Parameters:
+        cat_features (list): Categorical features to count.
+        values (dict): Counted values of every categorical feature.
+        columns (list): Column order of the matrix, the date components, the
+                        traffic and the counted values by default.
+        """
+        self.cat_features = list(cat_features)
+        self.values = {
+            col: [str(v) for v in values[col]] for col in cat_features
+        }
+        self.columns = (
+            list(columns)
+            if columns is not None
+            else [
+                *date_features,
+                "traffic",
+                *(
+                    f"{col}_{value}"
+                    for col in self.cat_features
+                    for value in self.values[col]
+                ),
+            ]
+        )
+        self._compile()
+
+    def _compile(self):
+        """Resolve the position of every column once, for the transforms"""
+        positions = {column: i for i, column in enumerate(self.columns)}
+        self._date_positions = [
+            (col, positions[col]) for col in date_features if col in positions
+        ]
+        self._traffic_position = positions.get("traffic")
+        self._lookups = {}
+        for col in self.cat_features:
+            lookup = {
+                value: positions[f"{col}_{value}"]
+                for value in self.values[col]
+                if f"{col}_{value}" in positions and value != other_value
+            }
+            other = positions.get(f"{col}_{other_value}")
+            self._lookups[col] = (lookup, other)
+
+    @property
+    def counted_columns(self):
+        """The columns of the matrix which are counted from the events"""
+        return [col for col in self.columns if col not in date_features]
+
+    @classmethod
+    def fit(cls, events, cat_features, vocabulary_size=None):
+        """
+        Fit the counted values of every categorical feature to the events,
+        every value sorted as ``pd.get_dummies`` does, or the most frequent
+        values and ``__other__`` with ``vocabulary_size``.
+        """
+        if vocabulary_size is not None:
+            vocabularies = fit_vocabularies(
+                {col: events[col].value_counts() for col in cat_features},
+                vocabulary_size,
+            )
+            values = {
+                col: [*vocabularies[col], other_value] for col in cat_features
+            }
+        else:
+            values = {
+                col: sorted(
+                    events[col][events[col] != "\\N"].dropna().unique()
+                )
+                for col in cat_features
+            }
+        return cls(cat_features, values)
+
+    @classmethod
+    def from_columns(cls, cols, cat_features):
+        """The pipeline of a model trained before the pipeline was saved"""
+        return cls(cat_features, category_values(cols, cat_features), cols)
+
+    def transform(self, events):
+        """
+        Count the events of every pid and hour.
+
+        Parameters:
+        events (pd.DataFrame): Events with ``agg_cols`` and the raw values of
+                               the categorical features.
+
+        Returns:
+        pd.DataFrame: The ``agg_cols`` of every row of the matrix, in the
+                      order of the first event.
+        np.ndarray: The features of every pid and hour in ``columns`` order.
+        """
+        codes = events.groupby(agg_cols, sort=False, observed=True).ngroup()
+        codes = codes.to_numpy()
+        keys = events[agg_cols].drop_duplicates().reset_index(drop=True)
+        width = len(self.columns)
+
+        # Every event is counted at a flat position of the matrix
+        positions = []
+        if self._traffic_position is not None:
+            positions.append(codes * width + self._traffic_position)
+        for col, (lookup, other) in self._lookups.items():
+            # Only the distinct values are looked up, -1 is not counted: the
+            # null values are factorized as -1, the last entry of ``targets``
+            values, uniques = pd.factorize(events[col])
+            unknown = -1 if other is None else other
+            targets = np.array(
+                [
+                    -1 if value == "\\N" else lookup.get(value, unknown)
+                    for value in uniques.astype(str)
+                ]
+                + [-1],
+                dtype=np.int64,
+            )[values]
+            counted = targets >= 0
+            positions.append(codes[counted] * width + targets[counted])
+
+        X = np.bincount(
+            np.concatenate(positions), minlength=len(keys) * width
+        ).reshape(len(keys), width)
+        X = X.astype(np.float64)
+        for col, position in self._date_positions:
+            X[:, position] = keys[col].to_numpy()
+        return keys, X
+
+    def transform_counts(self, df):
+        """
+        Lay out the counts aggregated by ClickHouse, one row per pid and hour
+        with ``agg_cols`` and the counted columns, as the matrix of
+        ``transform``. The values which were not counted are 0.
+        """
+        keys = df[agg_cols].reset_index(drop=True)
+        X = df.reindex(columns=self.columns, fill_value=0).to_numpy(
+            dtype=np.float64
+        )
+        return keys, X
+
+    def to_dict(self):
+        return {
+            "cat_features": self.cat_features,
+            "values": self.values,
+            "columns": self.columns,
+        }
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            return cls(**json.load(file))
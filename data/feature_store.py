@@ -0,0 +1,140 @@
+import os
+import json
+import uuid
+import shutil
+import pandas as pd
+from dotenv import load_dotenv
+from logging_config import setup_logger
+
+logger = setup_logger("feature_store")
+
+"""
+Local on-disk store of the hourly aggregated traffic, so every training run
+only aggregates the hours which were not ingested before.
+
+The rows are returned by ``aggregation.query_hourly_traffic``: one row per pid
+and hour with ``agg_cols``, the counted columns and the first (``min``) and
+last (``max``) event of the hour. They are stored as Parquet files partitioned
+by pid and month:
+
+    feature_store/
+        pid=<pid>/watermark.json        # first hour which is not stored
+        pid=<pid>/month=<YYYY-MM>.parquet
+
+Every file belongs to a single pid, so the training shards, which have
+disjoint pids, update the same store concurrently.
+"""
+
+
+class FeatureStore:
+    def __init__(self, directory=None):
+        load_dotenv()
+        self.directory = directory or os.getenv(
+            "FEATURE_STORE_DIR", "feature_store/"
+        )
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _watermark_path(self, pid):
+        return os.path.join(self.directory, f"pid={pid}", "watermark.json")
+
+    def _partition_path(self, pid, month):
+        return os.path.join(
+            self.directory, f"pid={pid}", f"month={month}.parquet"
+        )
+
+    def _replace_file(self, path, write):
+        """Write the file next to ``path`` and move it in place atomically"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+
+    def load_watermarks(self, pids):
+        """Return the first hour which is not stored yet for the ``pids``"""
+        watermarks = {}
+        for pid in pids:
+            path = self._watermark_path(pid)
+            if os.path.exists(path):
+                with open(path) as file:
+                    watermarks[pid] = pd.Timestamp(json.load(file)["hour"])
+        return watermarks
+
+    def save_watermarks(self, watermarks):
+        for pid, hour in watermarks.items():
+
+            def write(path):
+                with open(path, "w") as file:
+                    json.dump({"hour": hour.isoformat()}, file)
+
+            self._replace_file(self._watermark_path(pid), write)
+
+    def write(self, df):
+        """
+        Store the hourly traffic, the stored hours are replaced by the hours of
+        ``df``, so writing the same hours twice keeps the store consistent.
+        """
+        # Pids without events since the watermark have nothing to store, and
+        # the empty result of ClickHouse has no datetime columns
+        if df.empty:
+            return
+        hours = df["min"].dt.floor("h")
+        for (pid, month), rows in df.groupby(
+            [df["pid"], hours.dt.strftime("%Y-%m")]
+        ):
+            path = self._partition_path(pid, month)
+            if os.path.exists(path):
+                stored = pd.read_parquet(path)
+                stored = stored[
+                    ~stored["min"].dt.floor("h").isin(hours[rows.index])
+                ]
+                rows = pd.concat([stored, rows]).fillna(0)
+            rows = rows.sort_values("min").reset_index(drop=True)
+            self._replace_file(path, rows.to_parquet)
+
+    def read(self, pids, start_hour):
+        """Return the stored hourly traffic of ``pids`` since ``start_hour``"""
+        first_month = start_hour.strftime("%Y-%m")
+        partitions = []
+        for pid in pids:
+            directory = os.path.join(self.directory, f"pid={pid}")
+            if not os.path.isdir(directory):
+                continue
+            for filename in sorted(os.listdir(directory)):
+                if not filename.endswith(".parquet"):
+                    continue
+                if filename[len("month=") : -len(".parquet")] < first_month:
+                    continue
+                df = pd.read_parquet(os.path.join(directory, filename))
+                partitions.append(df[df["min"] >= start_hour])
+
+        if not partitions:
+            return pd.DataFrame()
+        return pd.concat(partitions, ignore_index=True).fillna(0)
+
+    def drop_partitions_before(self, start_hour, pids=None):
+        """
+        Remove the months which are entirely before ``start_hour``, of the
+        ``pids`` only if they are given
+        """
+        first_month = start_hour.strftime("%Y-%m")
+        if pids is None:
+            directories = os.listdir(self.directory)
+        else:
+            directories = [f"pid={pid}" for pid in pids]
+        for directory in directories:
+            path = os.path.join(self.directory, directory)
+            if not os.path.isdir(path):
+                continue
+            dropped, kept = 0, 0
+            for filename in os.listdir(path):
+                if not filename.endswith(".parquet"):
+                    continue
+                if filename[len("month=") : -len(".parquet")] < first_month:
+                    os.remove(os.path.join(path, filename))
+                    logger.info(f"Dropped partition {directory}/{filename}")
+                    dropped += 1
+                else:
+                    kept += 1
+            # The watermark of a pid is dropped with its last partition
+            if dropped and not kept:
+                shutil.rmtree(path)
@@ -1,8 +1,26 @@
 import pandas as pd
 import numpy as np
-from constants import columns, date_col, agg_cols
+from scipy import sparse as scipy_sparse
+from constants import (
+    date_col,
+    agg_cols,
+    cat_columns,
+    dictionary_columns,
+    stream_block_size,
+)
 from logging_config import setup_logger
 from clickhouse.client import clickhouse_client
+from data import aggregation
+from data.feature_store import FeatureStore
+from data.feature_pipeline import FeaturePipeline, date_features
+from data.vocabulary import (
+    other_value,
+    fit_vocabularies,
+    encode_values,
+    collapse_columns,
+    vocabulary_columns,
+)
+from utils.instrumentation import stage
 
 logger = setup_logger("load_data")
 
@@ -11,16 +29,95 @@ import warnings
 warnings.filterwarnings("ignore")
 
 
-def read_data_csv():
-    """Read the data from analytics in clickhouse with encodings and add columns to it"""
-    data = clickhouse_client.execute_query("SELECT * FROM analytics")
-    df = pd.DataFrame(data.result_rows, columns=columns)
+def select_column(col):
+    """
+    Select the column of analytics for ``ClickHouseClient.query_frame``, the
+    low cardinality strings as dictionaries and the date column as a
+    timestamp
+    """
+    if col == date_col:
+        return f"toDateTime64(`{col}`, 0) AS `{col}`"
+    if col in dictionary_columns:
+        return f"toLowCardinality(`{col}`) AS `{col}`"
+    return f"`{col}`"
+
+
+def read_data_csv(projection=None, pids=None):
+    """
+    Read the data from analytics in clickhouse with encodings and add columns to it,
+    only the ``projection`` columns are read if they are given and only the
+    events of ``pids`` if they are given. The events are fetched as Arrow
+    columns, ``pid`` and the categorical features as categoricals.
+    """
+    where = "WHERE pid IN %(pids)s" if pids is not None else ""
+    parameters = {"pids": tuple(pids) if pids is not None else None}
+    if projection is not None:
+        query = ", ".join(select_column(col) for col in projection)
+        return clickhouse_client.query_frame(
+            f"SELECT {query} FROM analytics {where}", parameters=parameters
+        )
 
     # Exclude specific columns
-    columns_to_exclude = ["meta.key", "meta.value"]
-    df = df.drop(columns=columns_to_exclude)
+    replaced = ", ".join(
+        select_column(col) for col in [*dictionary_columns, date_col]
+    )
+    return clickhouse_client.query_frame(
+        "SELECT * EXCEPT (`meta.key`, `meta.value`) "
+        f"REPLACE ({replaced}) FROM analytics {where}",
+        parameters=parameters,
+    )
 
-    return df
+
+def select_cat_features(cardinality, threshold=300):
+    """
+    Select categorical features by their uniqueness count, the same way as
+    ``categorize_features`` does, but without the raw data at hand.
+
+    Parameters:
+    cardinality (dict): The amount of unique values per column.
+    threshold (int): The maximum number of unique values a column can have to be
+                     considered a categorical feature (default is 300).
+
+    Returns:
+    list: A list of columns that are kept as categorical features.
+    """
+    cat_features = [
+        col for col in cat_columns if cardinality[col] <= threshold
+    ]
+    dropped_cols = [col for col in cat_columns if col not in cat_features]
+
+    logger.info(f"Dropped columns: {dropped_cols}")
+    logger.info(f"Kept columns (Categorical Features): {cat_features}")
+
+    return cat_features
+
+
+def stream_data_blocks(start_date, pids, cat_features, block_size):
+    """
+    Stream the analytics of the ``pids`` since ``start_date`` from ClickHouse,
+    only the ``pid``, ``created`` and categorical feature columns are fetched.
+
+    Yields:
+    pd.DataFrame: Block of at most ``block_size`` events.
+    """
+    block_columns = ["pid", *cat_features, date_col]
+    projection = ", ".join(f"`{col}`" for col in block_columns)
+    query = f"""
+    SELECT {projection}
+    FROM analytics
+    WHERE {date_col} >= %(start_date)s AND pid IN %(pids)s
+    """
+    stream = clickhouse_client.stream_query(
+        query,
+        parameters={
+            "start_date": start_date.to_pydatetime(),
+            "pids": tuple(pids),
+        },
+        block_size=block_size,
+    )
+    with stream:
+        for block in stream:
+            yield pd.DataFrame(block, columns=block_columns)
 
 
 def sort_df_by_date_col(date_col, df):
@@ -44,6 +141,8 @@ def filter_df_by_specific_date(df, time_delta_years=1):
 # To save memory and time, train with top 15 most frequent pid
 def filter_df_with_most_frequent_pid(df, project_amount=15):
     """Group dataframe by pid, and filter df to leave only those specific pids"""
+    if project_amount is None:
+        return df
     x = df.pid.value_counts().head(project_amount).reset_index()
     pid = x["pid"].unique()
     df = df[df.pid.isin(pid)]
@@ -65,7 +164,8 @@ def categorize_features(df, id_column="pid", threshold=300):
     df (pd.DataFrame): The input DataFrame.
     id_column (str): The column to exclude from categorization (default is "pid").
     threshold (int): The maximum number of unique values a column can have to be
-                     considered a categorical feature (default is 100).
+                     considered a categorical feature (default is 100), every
+                     column is kept if it is ``None``.
 
     Returns:
     pd.DataFrame: The DataFrame with high-uniqueness columns dropped.
@@ -79,11 +179,11 @@ def categorize_features(df, id_column="pid", threshold=300):
     for col in columns_to_process:
         n = df[col].nunique()
         # Additionaly exclude campaing columns too hard to predict right now and resource consuming
-        if col not in ["dv", "br", "os", "lc", "cc", "unique"]:
+        if col not in cat_columns:
             df.drop(col, axis=1, inplace=True)
             continue
 
-        if n > threshold:
+        if threshold is not None and n > threshold:
             df.drop(col, axis=1, inplace=True)
             dropped_cols.append(col)
         else:
@@ -120,56 +220,132 @@ def add_traffic_table(df):
     return df
 
 
-def convert_cat_features_to_dummies(df, cat_features):
+def convert_cat_features_to_dummies(df, cat_features, dtype="int"):
     """Convert categorical variable into dummy/indicator variables."""
-    df = pd.get_dummies(df, columns=cat_features, dtype="int")
+    df = pd.get_dummies(df, columns=cat_features, dtype=dtype)
     return df
 
 
-def process_pid_data(df, pid, date_col, agg_cols):
+def memory_usage_mb(df):
+    """Return the memory used by the DataFrame in megabytes"""
+    return df.memory_usage(deep=True).sum() / 1024**2
+
+
+def compact_dtypes(df):
     """
-    Processes data for a single pid, aggregating traffic and generating a DataFrame with hourly date ranges.
+    Converts the counts and the date components to the narrowest unsigned
+    integer types which fit their values, and ``pid`` to a category.
 
     Parameters:
-    df (pd.DataFrame): The input DataFrame.
-    pid (str): The unique identifier for the data subset.
-    date_col (str): The name of the date column.
-    agg_cols (list): Columns to group by when aggregating traffic.
+    df (pd.DataFrame): The combined DataFrame for all pids.
 
     Returns:
-    pd.DataFrame: The processed DataFrame for the given pid.
+    pd.DataFrame: The DataFrame with compact column types.
     """
-    # Filter data for the given pid
-    df_pid = df[df.pid == pid]
+    before = memory_usage_mb(df)
+
+    # Sparse counts only store their non zero values
+    numeric = [
+        col
+        for col in df.columns.drop(["pid", date_col], errors="ignore")
+        if not isinstance(df[col].dtype, pd.SparseDtype)
+    ]
+    dtypes = {
+        col: np.min_scalar_type(int(value))
+        for col, value in df[numeric].max().fillna(0).items()
+    }
+    df = df.astype({**dtypes, "pid": "category"})
+
+    logger.info(
+        f"Compacted training data from {before:.1f} MB"
+        f" to {memory_usage_mb(df):.1f} MB"
+    )
+    return df
 
-    # Determine the start and end timestamps
-    start_timestamp = df_pid["created"].min()
-    end_timestamp = df_pid["created"].max()
 
-    # Drop the original date column
-    df_pid.drop([date_col], axis=1, inplace=True)
+def sparse_features(df, cols):
+    """
+    Keep the feature columns as sparse columns filled with 0, most of the
+    counted categories are 0 in any given hour. The targets stay dense, as
+    the models are fitted with dense targets only.
+
+    The counts are already sparse when ``build_hourly_grid`` placed them in
+    sparse columns, so only the date components are converted here.
+    """
+    dtype = pd.SparseDtype("float32", 0)
+    dense = [col for col in cols if df[col].dtype != dtype]
+    df = df.astype({col: dtype for col in dense})
+    features = df[cols]
+    logger.info(
+        f"Sparse features use {memory_usage_mb(features):.1f} MB, "
+        f"converted {len(dense)} dense columns, "
+        f"density {features.sparse.density:.3f}"
+    )
+    return df
 
-    # Aggregate traffic data
-    traffic = df_pid.groupby(agg_cols).sum().reset_index()
 
-    # Create a date range with an hourly frequency
-    date_range = pd.date_range(
-        start=start_timestamp, end=end_timestamp, freq="H"
+def aggregate_pid_bounds(df, date_col):
+    """Return the first and last event of every pid in the order of appearance"""
+    return df.groupby("pid", sort=False, observed=True)[date_col].agg(
+        ["min", "max"]
     )
 
-    # Create a DataFrame from the date range
-    x = pd.DataFrame(date_range, columns=[date_col])
 
-    # Extract date components
-    x = extract_date_components(x, date_col)
+def build_hourly_grid(traffic, bounds, date_col, sparse=False):
+    """
+    Builds a DataFrame with every hour between the first and the last event of
+    every pid at once, and fills it with the aggregated traffic.
 
-    # Merge the aggregated traffic data with the date range DataFrame
-    y = pd.merge(x, traffic, how="left")
+    Parameters:
+    traffic (pd.DataFrame): The traffic of all pids indexed by ``agg_cols``.
+    bounds (pd.DataFrame): The first and last event of every pid.
+    date_col (str): The name of the date column.
+    sparse (bool): Place the traffic straight into sparse columns filled with
+                   0, without a dense column for the hours of the grid.
 
-    # Add the pid column
-    y["pid"] = pid
+    Returns:
+    pd.DataFrame: The combined DataFrame for all pids.
+    """
+    # Amount of hours of every pid, as ``pd.date_range`` with an hourly frequency
+    hours = (bounds["max"] - bounds["min"]) // pd.Timedelta(hours=1) + 1
+    hours = hours.to_numpy(dtype="int64")
+    starts = np.repeat(np.cumsum(hours) - hours, hours)
+    offsets = np.arange(hours.sum()) - starts
+
+    grid = pd.DataFrame(
+        {
+            date_col: np.repeat(bounds["min"].to_numpy(), hours)
+            + offsets * np.timedelta64(1, "h")
+        },
+        index=offsets,
+    )
+    grid = extract_date_components(grid, date_col)
+    grid["pid"] = np.repeat(bounds.index.to_numpy(), hours)
+
+    if sparse:
+        # Only the hours with traffic are stored, at their rows of the grid
+        rows = pd.MultiIndex.from_frame(grid[agg_cols]).get_indexer(
+            traffic.index
+        )
+        found = rows >= 0
+        matrix = scipy_sparse.coo_matrix(traffic.to_numpy(np.float32)[found])
+        matrix = scipy_sparse.csc_matrix(
+            (matrix.data, (rows[found][matrix.row], matrix.col)),
+            shape=(len(grid), traffic.shape[1]),
+        )
+        values = pd.DataFrame.sparse.from_spmatrix(
+            matrix, index=grid.index, columns=traffic.columns
+        )
+        return pd.concat([grid, values], axis=1)
+
+    # Look up the traffic of every (pid, hour) of the grid
+    values = traffic.reindex(pd.MultiIndex.from_frame(grid[agg_cols]))
+    values.index = grid.index
+    combined_df = pd.concat([grid, values], axis=1)
 
-    return y
+    # Fill in empty values in the combined df
+    combined_df = combined_df.fillna(0)
+    return combined_df
 
 
 def combine_all_pids(df, date_col, agg_cols):
@@ -184,16 +360,115 @@ def combine_all_pids(df, date_col, agg_cols):
     Returns:
     pd.DataFrame: The combined DataFrame for all pids.
     """
-    combined_df = pd.DataFrame()
+    bounds = aggregate_pid_bounds(df, date_col)
+    traffic = (
+        df.drop([date_col], axis=1).groupby(agg_cols, observed=True).sum()
+    )
+    return build_hourly_grid(traffic, bounds, date_col)
 
-    # Process each unique pid and combine the results
-    for pid in df.pid.unique():
-        y = process_pid_data(df, pid, date_col, agg_cols)
-        combined_df = pd.concat([combined_df, y], axis=0)
 
-    # Fill in empty values in the combined df
-    combined_df = combined_df.fillna(0)
-    return combined_df
+def aggregate_block(df, cat_features, vocabularies=None):
+    """
+    Aggregates a block of raw events by ``agg_cols``.
+
+    Parameters:
+    df (pd.DataFrame): Block of events with ``pid``, ``created`` and categorical
+                       feature columns.
+    cat_features (list): List of categorical features to be one-hot encoded.
+    vocabularies (dict): Values of every categorical feature to count, the
+                         others are counted as ``__other__``.
+
+    Returns:
+    pd.DataFrame: The traffic of the block indexed by ``agg_cols``.
+    pd.DataFrame: The first and last event of every pid in the block.
+    """
+    df = convert_df_to_datetime(df)
+    df = replace_null_values(df)
+    df = extract_date_components(df, date_col)
+    df = add_traffic_table(df)
+    if vocabularies is not None:
+        df = encode_values(df, vocabularies)
+    df = convert_cat_features_to_dummies(df, cat_features)
+
+    bounds = aggregate_pid_bounds(df, date_col)
+    traffic = df.drop([date_col], axis=1).groupby(agg_cols).sum()
+    return traffic, bounds
+
+
+def fold_hourly_traffic(traffic, blocks):
+    """Sum the traffic of the ``blocks`` into the running ``traffic``"""
+    if not blocks:
+        return traffic
+    return (
+        pd.concat([traffic, *blocks]).fillna(0).groupby(level=agg_cols).sum()
+    )
+
+
+def stream_hourly_traffic(
+    start_date, pids, cat_features, block_size, vocabularies=None
+):
+    """
+    Folds streamed blocks of events into the hourly traffic, so only one block
+    of raw events is kept in memory at a time.
+
+    Parameters:
+    start_date (pd.Timestamp): The earliest ``created`` timestamp to read.
+    pids (list): The pids to read the events for.
+    cat_features (list): List of categorical features to be one-hot encoded.
+    block_size (int): Amount of events read from ClickHouse at a time.
+    vocabularies (dict): Values of every categorical feature to count, the
+                         others are counted as ``__other__``.
+
+    Returns:
+    pd.DataFrame: The traffic of all pids indexed by ``agg_cols``.
+    pd.DataFrame: The first and last event of every pid.
+    """
+    traffic = pd.DataFrame()
+    blocks = []
+    buffered = 0
+    bounds = []
+    values = {col: set() for col in cat_features}
+
+    for block in stream_data_blocks(
+        start_date, pids, cat_features, block_size
+    ):
+        block = replace_null_values(block)
+        for col in cat_features:
+            values[col].update(block[col].dropna().unique())
+
+        block_traffic, block_bounds = aggregate_block(
+            block, cat_features, vocabularies
+        )
+        blocks.append(block_traffic)
+        buffered += len(block_traffic)
+        bounds.append(block_bounds)
+        # The block aggregates are folded in once they outgrow the running
+        # aggregate, so every row is grouped again a bounded amount of times
+        if buffered > len(traffic):
+            traffic = fold_hourly_traffic(traffic, blocks)
+            blocks, buffered = [], 0
+    traffic = fold_hourly_traffic(traffic, blocks)
+    bounds = (
+        pd.concat(bounds).groupby(level=0).agg({"min": "min", "max": "max"})
+        if bounds
+        else pd.DataFrame()
+    )
+
+    # Keep the column order and types of ``pd.get_dummies`` over the whole data
+    if vocabularies is not None:
+        dummies = vocabulary_columns(vocabularies)
+    else:
+        dummies = [
+            f"{col}_{value}"
+            for col in cat_features
+            for value in sorted(values[col])
+        ]
+    traffic = traffic.reindex(columns=["traffic", *dummies], fill_value=0)
+    traffic = traffic.astype("int64")
+
+    # Keep the pids in the order of their first event, as ``df.pid.unique()``
+    bounds = bounds.sort_values("min", kind="stable")
+    return traffic, bounds
 
 
 def set_target_columns(df):
@@ -214,10 +489,23 @@ def get_cols_withohut_pid(df):
     return df, cols
 
 
-def create_target_traffic_by_target_columns(df, target_columns):
-    """Extract the traffic for next hours"""
-    next_hrs = []
-    for hr in [
+def create_target_traffic_by_target_columns(df, target_columns, dtype=None):
+    """
+    Extract the traffic for next hours of all target columns at once.
+
+    The leads are calculated over a single NumPy block with the rows of every
+    pid next to each other, and added to the DataFrame with a single concat.
+
+    Parameters:
+    df (pd.DataFrame): The combined DataFrame for all pids.
+    target_columns (list): The columns to extract the next hours for.
+    dtype (str): Type of the extracted columns (default is float64).
+
+    Returns:
+    pd.DataFrame: The DataFrame with the next hours columns.
+    list: The names of the next hours columns.
+    """
+    hours = [
         1,
         4,
         8,
@@ -225,37 +513,403 @@ def create_target_traffic_by_target_columns(df, target_columns):
         24,
         72,
         168,
-    ]:  # TODO dynamical value, as well dynamical for the database
-        for (
-            target
-        ) in target_columns:  # TODO save target_columns into the database
-            df[f"{target}_next_{str(hr)}_hr"] = df.groupby("pid")[
-                target
-            ].shift(-1 * hr)
-            next_hrs = next_hrs + [f"{target}_next_{str(hr)}_hr"]
-    return next_hrs
-
-
-def pre_process_data():
-    # Pre-processing
-    df = read_data_csv()
+    ]  # TODO dynamical value, as well dynamical for the database
+    next_hrs = [
+        f"{target}_next_{str(hr)}_hr"
+        for hr in hours
+        for target in target_columns
+    ]
+
+    # Sort the rows by pid, keeping the order of the rows within every pid
+    codes, _ = pd.factorize(df["pid"])
+    order = np.argsort(codes, kind="stable")
+    values = df[target_columns].to_numpy(dtype=dtype or "float64")[order]
+
+    # Position of every row and the end of its pid in the sorted block
+    sizes = np.bincount(codes)
+    ends = np.repeat(np.cumsum(sizes), sizes)
+    positions = np.arange(len(df))
+
+    leads = np.full((len(df), len(next_hrs)), np.nan, dtype=dtype or "float64")
+    for i, hr in enumerate(hours):
+        rows = positions + hr < ends
+        block = leads[
+            :, i * len(target_columns) : (i + 1) * len(target_columns)
+        ]
+        block[order[rows]] = values[positions[rows] + hr]
+
+    leads = pd.DataFrame(leads, columns=next_hrs, index=df.index)
+    df = pd.concat([df, leads], axis=1)
+    return df, next_hrs
+
+
+def load_hourly_data(
+    project_amount=15,
+    compact=False,
+    pids=None,
+    threshold=300,
+    vocabulary_size=None,
+    sparse=False,
+):
+    """
+    Read all analytics into memory and aggregate them by pid and hour with the
+    ``FeaturePipeline`` fitted to them, with ``compact`` only the used columns
+    are read. With ``vocabulary_size`` every categorical feature counts its
+    most frequent values and ``__other__`` instead of the ``threshold``.
+    """
+    if compact:
+        df = read_data_csv(
+            projection=["pid", *cat_columns, date_col], pids=pids
+        )
+    else:
+        df = read_data_csv(pids=pids)
     df = sort_df_by_date_col(date_col, df)
     df = convert_df_to_datetime(df)
     df = filter_df_by_specific_date(df, time_delta_years=1)
-    df = filter_df_with_most_frequent_pid(df)
+    if pids is None:
+        df = filter_df_with_most_frequent_pid(df, project_amount)
     df = replace_null_values(df)
-    df, cat_features = categorize_features(df)
+    df, cat_features = categorize_features(
+        df, threshold=threshold if vocabulary_size is None else None
+    )
     df = extract_date_components(df, date_col)
-    df = add_traffic_table(df)
-    df = convert_cat_features_to_dummies(df, cat_features)
-    df = combine_all_pids(df, date_col, agg_cols)
+    pipeline = FeaturePipeline.fit(df, cat_features, vocabulary_size)
+    keys, X = pipeline.transform(df)
+    traffic = pd.DataFrame(
+        X[:, len(date_features) :],
+        index=pd.MultiIndex.from_frame(keys),
+        columns=pipeline.counted_columns,
+    )
+    df = build_hourly_grid(
+        traffic, aggregate_pid_bounds(df, date_col), date_col, sparse
+    )
+    return df, cat_features
+
+
+def stream_hourly_data(
+    time_delta_years=1,
+    project_amount=15,
+    block_size=stream_block_size,
+    pids=None,
+    threshold=300,
+    vocabulary_size=None,
+    sparse=False,
+):
+    """
+    Aggregate analytics by pid and hour while streaming them from ClickHouse.
+
+    The date window, the most frequent pids and the column projection are
+    applied in the query, so the peak memory depends on the size of the hourly
+    aggregates rather than on the amount of raw events.
+    """
+    start_date = aggregation.get_max_created() - pd.DateOffset(
+        years=time_delta_years
+    )
+    if pids is None:
+        pids = aggregation.get_most_frequent_pids(start_date, project_amount)
+    vocabularies = None
+    if vocabulary_size is not None:
+        vocabularies = aggregation.get_top_values(
+            start_date, pids, vocabulary_size
+        )
+        cat_features = list(vocabularies)
+    else:
+        cat_values = aggregation.get_cat_values(start_date, pids, threshold)
+        cardinality = {col: len(values) for col, values in cat_values.items()}
+        cat_features = select_cat_features(cardinality, threshold)
+
+    traffic, bounds = stream_hourly_traffic(
+        start_date, pids, cat_features, block_size, vocabularies
+    )
+    df = build_hourly_grid(traffic, bounds, date_col, sparse)
+    return df, cat_features
+
+
+def aggregate_hourly_data(
+    rollup=False,
+    time_delta_years=1,
+    project_amount=15,
+    threshold=300,
+    pids=None,
+    vocabulary_size=None,
+    sparse=False,
+):
+    """
+    Aggregate analytics by pid and hour inside ClickHouse, so only one row per
+    pid and hour is transferred to Python.
+
+    Parameters:
+    rollup (bool): Read the counts from the ``analytics_hourly`` rollup table
+                   instead of the raw analytics.
+    """
+    start_date = aggregation.get_max_created(rollup) - pd.DateOffset(
+        years=time_delta_years
+    )
+    if pids is None:
+        pids = aggregation.get_most_frequent_pids(
+            start_date, project_amount, rollup
+        )
+    if vocabulary_size is not None:
+        # The values outside of the vocabularies are counted by ClickHouse
+        cat_values = {
+            col: [*values, other_value]
+            for col, values in aggregation.get_top_values(
+                start_date, pids, vocabulary_size, rollup
+            ).items()
+        }
+        cat_features = list(cat_values)
+    else:
+        cat_values = aggregation.get_cat_values(
+            start_date, pids, threshold, rollup
+        )
+        cardinality = {col: len(values) for col, values in cat_values.items()}
+        cat_features = select_cat_features(cardinality, threshold)
+        cat_values = {col: cat_values[col] for col in cat_features}
+
+    traffic, bounds = aggregation.aggregate_hourly_traffic(
+        start_date, pids, cat_values, rollup
+    )
+    df = build_hourly_grid(traffic, bounds, date_col, sparse)
+    return df, cat_features
+
+
+def update_feature_store(store, start_hour, end_hour, pids, lookback_hours):
+    """
+    Aggregate the hours of ``pids`` which are not stored yet, and store the
+    complete ones, before ``end_hour``.
+
+    Parameters:
+    store (FeatureStore): The store with the hourly traffic.
+    start_hour (pd.Timestamp): The first complete hour of the training window.
+    end_hour (pd.Timestamp): The most recent hour, which is still incomplete.
+    pids (list): The pids to update.
+    lookback_hours (int): Amount of stored hours before the watermark which
+                          are aggregated again to pick up late events.
+
+    Returns:
+    pd.DataFrame: The hourly traffic of the incomplete hour.
+    """
+    watermarks = store.load_watermarks(pids)
+    lookback = pd.Timedelta(hours=lookback_hours)
+
+    # Pids ingested up to the same hour are aggregated with a single query
+    pids_since = {}
+    for pid in pids:
+        if pid in watermarks:
+            since = max(watermarks[pid] - lookback, start_hour)
+        else:
+            since = start_hour
+        pids_since.setdefault(since, []).append(pid)
+
+    incomplete = []
+    for since, since_pids in pids_since.items():
+        cat_values = aggregation.get_cat_values(
+            since, since_pids, threshold=None
+        )
+        df = aggregation.query_hourly_traffic(since, since_pids, cat_values)
+        logger.info(
+            f"Aggregated {len(df)} hours of {len(since_pids)} pids since {since}"
+        )
+
+        complete = df["min"] < end_hour
+        store.write(df[complete])
+        if not df.empty:
+            incomplete.append(df[~complete])
+        store.save_watermarks({pid: end_hour for pid in since_pids})
+
+    if not incomplete:
+        return pd.DataFrame()
+    return pd.concat(incomplete, ignore_index=True)
+
+
+def incremental_hourly_data(
+    time_delta_years=1,
+    project_amount=15,
+    threshold=300,
+    lookback_hours=24,
+    pids=None,
+    vocabulary_size=None,
+    sparse=False,
+):
+    """
+    Aggregate analytics by pid and hour with the local feature store, only the
+    hours after the per-pid watermark are aggregated by ClickHouse.
+
+    The hour at the start of the training window is cut at the exact time and
+    the current hour is incomplete, so both of them are always aggregated by
+    ClickHouse and never stored. The last ``lookback_hours`` before the
+    watermark are aggregated again, so the result is the same as a full
+    rebuild with the ``clickhouse`` ingestion as long as events do not arrive
+    later than that.
+    """
+    store = FeatureStore()
+
+    max_date = aggregation.get_max_created()
+    start_date = max_date - pd.DateOffset(years=time_delta_years)
+    start_hour = start_date.floor("h") + pd.Timedelta(hours=1)
+    end_hour = max_date.floor("h")
+    if pids is None:
+        pids = aggregation.get_most_frequent_pids(start_date, project_amount)
+
+    # Other training shards update the partitions of their own pids
+    store.drop_partitions_before(start_hour, pids)
+    incomplete = update_feature_store(
+        store, start_hour, end_hour, pids, lookback_hours
+    )
+    stored = store.read(pids, start_hour)
+
+    cat_values = aggregation.get_cat_values(
+        start_date, pids, threshold=None, end_date=start_hour
+    )
+    boundary = aggregation.query_hourly_traffic(
+        start_date, pids, cat_values, end_date=start_hour
+    )
+
+    df = pd.concat([boundary, stored, incomplete], ignore_index=True)
+    df = df.fillna(0)
+
+    # Categorical features are selected by the values seen within the window
+    counts = df.drop(columns=[*agg_cols, "traffic", "min", "max"]).sum()
+    if vocabulary_size is not None:
+        vocabularies = fit_vocabularies(
+            {
+                col: {
+                    name[len(col) + 1 :]: count
+                    for name, count in counts.items()
+                    if name.startswith(f"{col}_")
+                }
+                for col in cat_columns
+            },
+            vocabulary_size,
+        )
+        cat_features = list(vocabularies)
+        df = collapse_columns(df, vocabularies)
+        dummies = vocabulary_columns(vocabularies)
+    else:
+        cat_values = {
+            col: sorted(
+                name[len(col) + 1 :]
+                for name in counts[counts > 0].index
+                if name.startswith(f"{col}_")
+            )
+            for col in cat_columns
+        }
+        cardinality = {col: len(values) for col, values in cat_values.items()}
+        cat_features = select_cat_features(cardinality, threshold)
+        dummies = [
+            f"{col}_{value}"
+            for col in cat_features
+            for value in cat_values[col]
+        ]
+
+    traffic, bounds = aggregation.split_hourly_traffic(
+        df[[*agg_cols, "traffic", *dummies, "min", "max"]]
+    )
+    df = build_hourly_grid(traffic, bounds, date_col, sparse)
+    return df, cat_features
+
+
+def pre_process_data(
+    ingestion="memory",
+    project_amount=15,
+    compact=False,
+    pids=None,
+    sparse=False,
+    threshold=300,
+    vocabulary_size=None,
+):
+    """
+    Pre-process the analytics into the training data.
+
+    Parameters:
+    ingestion (str): ``memory`` reads the whole analytics table at once,
+                     ``stream`` reads it in blocks with a bounded memory,
+                     ``clickhouse`` aggregates it inside ClickHouse,
+                     ``rollup`` reads the ``analytics_hourly`` rollup table
+                     and ``feature_store`` only aggregates the new hours.
+    project_amount (int): Amount of the most frequent pids to train with,
+                          ``None`` trains with all of them.
+    compact (bool): Keep counts and date components in the narrowest integer
+                    types, ``pid`` as a category and the targets as float32.
+    pids (list): Train with these pids instead of the most frequent ones.
+    sparse (bool): Keep the features as sparse columns, the counts are placed
+                   in them straight from the aggregated traffic.
+    threshold (int): The maximum number of unique values of a categorical
+                     feature.
+    vocabulary_size (int): Keep every categorical feature with its most
+                           frequent values and an ``__other__`` value instead
+                           of dropping the features over the ``threshold``.
+
+    Returns:
+    pd.DataFrame: The training data.
+    list: The categorical features.
+    list: The feature columns.
+    list: The target columns.
+    FeaturePipeline: The pipeline laying out the raw events as ``cols``, to
+                     be saved with the model.
+    """
+    # Pre-processing
+    with stage("pre_process_data.load") as current:
+        if ingestion == "memory":
+            df, cat_features = load_hourly_data(
+                project_amount=project_amount,
+                compact=compact,
+                pids=pids,
+                threshold=threshold,
+                vocabulary_size=vocabulary_size,
+                sparse=sparse,
+            )
+        elif ingestion == "stream":
+            df, cat_features = stream_hourly_data(
+                project_amount=project_amount,
+                pids=pids,
+                threshold=threshold,
+                vocabulary_size=vocabulary_size,
+                sparse=sparse,
+            )
+        elif ingestion in ("clickhouse", "rollup"):
+            df, cat_features = aggregate_hourly_data(
+                rollup=ingestion == "rollup",
+                project_amount=project_amount,
+                threshold=threshold,
+                pids=pids,
+                vocabulary_size=vocabulary_size,
+                sparse=sparse,
+            )
+        elif ingestion == "feature_store":
+            df, cat_features = incremental_hourly_data(
+                project_amount=project_amount,
+                threshold=threshold,
+                pids=pids,
+                vocabulary_size=vocabulary_size,
+                sparse=sparse,
+            )
+        else:
+            raise ValueError(f"Unknown ingestion mode: {ingestion}")
+        current.shape(df)
+
+    if compact:
+        with stage("pre_process_data.compact") as current:
+            df = current.shape(compact_dtypes(df))
 
     # Setting data fro predictions
-    target_columns = set_target_columns(df)
-    df = remove_date_col(df)
-    df, cols = get_cols_withohut_pid(df)
-    next_hrs = create_target_traffic_by_target_columns(df, target_columns)
-
-    # Clear N/A
-    df = df.dropna()
-    return df, cat_features, cols, next_hrs
+    with stage("pre_process_data.targets") as current:
+        target_columns = set_target_columns(df)
+        df = remove_date_col(df)
+        df, cols = get_cols_withohut_pid(df)
+        df, next_hrs = create_target_traffic_by_target_columns(
+            df, target_columns, dtype="float32" if compact else None
+        )
+        current.shape(df)
+    logger.info(f"Training data uses {memory_usage_mb(df):.1f} MB")
+
+    # Clear N/A, only the next hours past the last hour of a pid are missing
+    # and checking every sparse column for them is slow
+    with stage("pre_process_data.dropna") as current:
+        df = current.shape(df.dropna(subset=next_hrs if sparse else None))
+
+    if sparse:
+        with stage("pre_process_data.sparse") as current:
+            df = current.shape(sparse_features(df, cols))
+    pipeline = FeaturePipeline.from_columns(cols, cat_features)
+    return df, cat_features, cols, next_hrs, pipeline
@@ -1,5 +1,18 @@
+import gzip
 import json
 import re
+import numpy as np
+from data.vocabulary import other_value
+
+timeframes = [
+    "next_1_hour",
+    "next_4_hour",
+    "next_8_hour",
+    "next_12_hour",
+    "next_24_hour",
+    "next_72_hour",
+    "next_168_hour",
+]
 
 
 def serialise_predictions(data):
@@ -37,30 +50,100 @@ def serialise_predictions(data):
     return results
 
 
-def serialise_data_for_sqlite(data):
+def build_target_layout(next_hrs, cat_features):
+    """
+    Map the output columns of the model to the time frame, category and field
+    of the predictions, once per training. The category is matched against
+    the categorical features, so fields with underscores are not split. The
+    traffic and the ``__other__`` targets are not served and left out of the
+    layout.
+
+    Returns:
+    list: ``[index, timeframe, category, field]`` of every served column.
+    """
+    layout = []
+    for index, name in enumerate(next_hrs):
+        column, _, hour = name.rpartition("_next_")
+        for category in cat_features:
+            if column.startswith(f"{category}_"):
+                timeframe = f"next_{hour[: -len('_hr')]}_hour"
+                field = column[len(category) + 1 :]
+                if field != other_value:
+                    layout.append([index, timeframe, category, field])
+                break
+    return layout
+
+
+def serialise_prediction_array(pids, y, layout):
+    """
+    Process the predictions of the model output array with the target layout
+    of ``build_target_layout``, the zeros are skipped with a NumPy mask.
+
+    Returns:
+    list: A dictionary per pid, in the format of ``serialise_predictions``.
+    """
+    indices = np.array([entry[0] for entry in layout], dtype=np.intp)
+    values = y[:, indices]
+    rows, positions = np.nonzero(values != 0)
+    bounds = np.searchsorted(rows, np.arange(len(pids) + 1)).tolist()
+    nonzero = values[rows, positions].tolist()
+    positions = positions.tolist()
+
+    results = []
+    for row, pid in enumerate(pids):
+        hours = {}
+        start, end = bounds[row], bounds[row + 1]
+        for position, value in zip(positions[start:end], nonzero[start:end]):
+            _, hour, category, field = layout[position]
+            hours.setdefault(hour, {}).setdefault(category, {})[field] = value
+        results.append({"pid": pid, **hours})
+
+    return results
+
+
+def render_response(record, compress=False):
+    """
+    Render the response body of ``/predict/`` for the processed record, so
+    the API can send it as is. ``None`` is returned when there is no
+    prediction for any time frame
+    """
+    predictions = {
+        timeframe: record[timeframe]
+        for timeframe in timeframes
+        if record.get(timeframe)
+    }
+    if not predictions:
+        return None
+
+    # Same encoding as the FastAPI JSON response
+    body = json.dumps(
+        predictions,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+    if compress:
+        return gzip.compress(body, mtime=0)
+    return body
+
+
+def serialise_data_for_sqlite(data, compress=False):
     """Serialise the processed data for SQLlite insertion"""
     serialized_data = []
+    content_encoding = "gzip" if compress else None
 
     for record in data:
-        pid = record["pid"]
-        next_1_hour = json.dumps(record.get("next_1_hour", {}))
-        next_4_hour = json.dumps(record.get("next_4_hour", {}))
-        next_8_hour = json.dumps(record.get("next_8_hour", {}))
-        next_12_hour = json.dumps(record.get("next_12_hour", {}))
-        next_24_hour = json.dumps(record.get("next_24_hour", {}))
-        next_72_hour = json.dumps(record.get("next_72_hour", {}))
-        next_168_hour = json.dumps(record.get("next_168_hour", {}))
-
         serialized_data.append(
             (
-                pid,
-                next_1_hour,
-                next_4_hour,
-                next_8_hour,
-                next_12_hour,
-                next_24_hour,
-                next_72_hour,
-                next_168_hour,
+                record["pid"],
+                *(
+                    json.dumps(record.get(timeframe, {}))
+                    for timeframe in timeframes
+                ),
+                render_response(record, compress),
+                content_encoding,
             )
         )
 
@@ -0,0 +1,103 @@
+import pandas as pd
+
+"""
+Fixed vocabularies of the categorical features.
+
+Every categorical feature keeps its ``size`` most frequent values within the
+training window, the remaining values are counted by the ``__other__`` value
+of the feature. The counted columns are named as the ``pd.get_dummies``
+columns and always laid out in the order of ``vocabulary_columns``, so the
+width of the features and the targets is bounded by the vocabulary size, no
+matter how many distinct values appear in the analytics.
+"""
+
+other_value = "__other__"
+
+
+def fit_vocabularies(counts, size):
+    """
+    Keep the ``size`` most frequent values of every categorical feature, the
+    ties are broken by the value, so the vocabularies are deterministic.
+
+    Parameters:
+    counts (dict): Amount of events of every value of every categorical
+                   feature, as a ``pd.Series`` or a dict.
+    size (int): The maximum amount of values per feature.
+
+    Returns:
+    dict: The kept values of every feature, the most frequent first.
+    """
+    vocabularies = {}
+    for col, col_counts in counts.items():
+        ranked = sorted(
+            (
+                (str(value), count)
+                for value, count in dict(col_counts).items()
+                if count > 0 and str(value) != other_value
+            ),
+            key=lambda item: (-item[1], item[0]),
+        )
+        vocabularies[col] = [value for value, _ in ranked[:size]]
+    return vocabularies
+
+
+def vocabulary_columns(vocabularies):
+    """The counted columns of the vocabularies, in their fixed order"""
+    return [
+        f"{col}_{value}"
+        for col, values in vocabularies.items()
+        for value in [*values, other_value]
+    ]
+
+
+def category_values(cols, cat_features):
+    """Values of every categorical feature which are counted by ``cols``"""
+    values = {col: [] for col in cat_features}
+    for column in cols:
+        for col in cat_features:
+            if column.startswith(f"{col}_"):
+                values[col].append(column[len(col) + 1 :])
+                break
+    return values
+
+
+def vocabularies_from_columns(cols, cat_features):
+    """The vocabularies the feature columns ``cols`` were built with"""
+    return {
+        col: [value for value in values if value != other_value]
+        for col, values in category_values(cols, cat_features).items()
+    }
+
+
+def encode_values(df, vocabularies):
+    """Replace the raw values outside of the vocabularies by ``__other__``"""
+    for col, values in vocabularies.items():
+        known = df[col].isna() | df[col].astype(str).isin(values)
+        df[col] = df[col].where(known, other_value)
+    return df
+
+
+def collapse_columns(df, vocabularies):
+    """
+    Sum the counted columns of ``df`` outside of the vocabularies into the
+    ``__other__`` column of their feature, and lay the counted columns out in
+    the order of ``vocabulary_columns``, the values which were not counted
+    are filled with 0. The other columns of ``df`` are kept in front.
+    """
+    counted = []
+    others = {}
+    for col, values in vocabularies.items():
+        prefix = f"{col}_"
+        kept = {f"{prefix}{value}" for value in values}
+        columns = [
+            column for column in df.columns if column.startswith(prefix)
+        ]
+        counted.extend(columns)
+        others[f"{prefix}{other_value}"] = [
+            column for column in columns if column not in kept
+        ]
+
+    values = df.reindex(columns=vocabulary_columns(vocabularies), fill_value=0)
+    for column, columns in others.items():
+        values[column] = df[columns].sum(axis=1) if columns else 0
+    return pd.concat([df.drop(columns=counted), values], axis=1)
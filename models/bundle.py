@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+class PidModelBundle:
+    """
+    Independent models trained per pid, every row is predicted by the model
+    of its pid.
+
+    Parameters:
+    models (dict): Fitted model of every pid.
+    next_hrs (list): Target columns the models were trained with.
+    """
+
+    def __init__(self, models, next_hrs):
+        self.models = models
+        self.next_hrs = next_hrs
+
+    def predict(self, X, pids):
+        """
+        Predict the rows of ``X`` with the models of their ``pids``, rows of
+        pids without a model are left as NaN.
+        """
+        if not sparse.issparse(X):
+            X = np.asarray(X)
+        pids = np.asarray(pids)
+        y = np.full((X.shape[0], len(self.next_hrs)), np.nan)
+        for pid, model in self.models.items():
+            rows = pids == pid
+            if rows.any():
+                y[rows] = model.predict(X[rows]).reshape(rows.sum(), -1)
+        return y
+
+
+def has_sparse_features(df, cols):
+    """Whether the feature columns of ``df`` are kept as sparse columns"""
+    return all(isinstance(dtype, pd.SparseDtype) for dtype in df[cols].dtypes)
+
+
+def fits_feature_matrix(model):
+    """Whether the model was fitted with a feature matrix, not a DataFrame"""
+    return isinstance(model, PidModelBundle) or not hasattr(
+        model, "feature_names_in_"
+    )
+
+
+def feature_matrix(df, cols):
+    """
+    Return the features of ``df`` as a CSR matrix. Sparse columns are not
+    densified and ``cols`` missing from ``df`` are left empty instead of
+    being filled with zeros.
+    """
+    present = [col for col in cols if col in df.columns]
+    if has_sparse_features(df, present):
+        matrix = df[present].sparse.to_coo()
+    else:
+        matrix = sparse.coo_matrix(df[present].to_numpy(np.float32))
+    positions = pd.Index(cols).get_indexer(present)
+    return sparse.csr_matrix(
+        (
+            matrix.data.astype(np.float32),
+            (matrix.row, positions[matrix.col]),
+        ),
+        shape=(len(df), len(cols)),
+    )
+
+
+def predict_frame(model, df, cols):
+    """Predict the rows of ``df`` with a single model or a model bundle"""
+    X = feature_matrix(df, cols) if fits_feature_matrix(model) else df[cols]
+    if isinstance(model, PidModelBundle):
+        return model.predict(X, df["pid"])
+    return model.predict(X)
+
+
+def predict_matrix(model, X, pids, cols):
+    """
+    Predict the rows of the feature matrix ``X`` of the ``pids``, laid out
+    as ``cols``, with a single model or a model bundle
+    """
+    if not fits_feature_matrix(model):
+        X = pd.DataFrame(X, columns=cols)
+    if isinstance(model, PidModelBundle):
+        return model.predict(X, pids)
+    return model.predict(X)
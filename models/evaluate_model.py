@@ -1,4 +1,7 @@
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
 from sklearn.metrics import r2_score, mean_absolute_error
+from models.bundle import predict_frame
 from logging_config import setup_logger
 
 logger = setup_logger("evaluate_model")
@@ -6,8 +9,137 @@ logger = setup_logger("evaluate_model")
 
 def evaluate_model(model, df, cols, next_hrs):
     """Evaluate R^2 and MAE metrics for the model"""
-    y_pred = model.predict(df[cols])
+    y_pred = predict_frame(model, df, cols)
     r2 = r2_score(df[next_hrs], y_pred)
     logger.info(f"R^2 score: {r2}")
     mae = mean_absolute_error(df[next_hrs], y_pred)
     logger.info(f"MAE: {mae}")
+
+
+def target_horizon(target):
+    """Hours ahead of the target column, e.g. 24 for ``traffic_next_24_hr``"""
+    return int(target.rpartition("_next_")[2][: -len("_hr")])
+
+
+def target_category(target, cat_features):
+    """Categorical feature of the target column, ``traffic`` for the traffic"""
+    column = target.rpartition("_next_")[0]
+    for category in cat_features:
+        if column.startswith(f"{category}_"):
+            return category
+    return "traffic"
+
+
+def split_holdout(df, next_hrs, hours):
+    """
+    Hold out the last ``hours`` rows of every pid for the backtest. The rows
+    before the holdout whose targets look into it are dropped from the
+    training rows as well, so no holdout traffic leaks into the model. The
+    pids which are too short to keep any training rows are not held out, all
+    of their rows are kept for training so the model still covers them.
+
+    Returns:
+    pd.DataFrame: The training rows.
+    pd.DataFrame: The holdout rows.
+    """
+    gap = max(target_horizon(target) for target in next_hrs)
+    # Rows of every pid are in chronological order, 0 is the last row
+    position = df.groupby("pid", sort=False, observed=True).cumcount(
+        ascending=False
+    )
+    train = position >= hours + gap
+    short = ~df["pid"].isin(df.loc[train, "pid"].unique())
+    if short.any():
+        logger.info(
+            f"Not backtesting {df.loc[short, 'pid'].nunique()} pids "
+            f"with less than {hours + gap + 1} hourly rows"
+        )
+    df, holdout = df[train | short], df[(position < hours) & ~short]
+    logger.info(
+        f"Held out {len(holdout)} rows, the last {hours} hours of every pid, "
+        f"training with {len(df)} rows"
+    )
+    return df, holdout
+
+
+def score(y_true, y_pred):
+    """R^2 and MAE of the predicted targets"""
+    return {
+        "r2": float(r2_score(y_true, y_pred)),
+        "mae": float(mean_absolute_error(y_true, y_pred)),
+    }
+
+
+def predict_rows(model, df, cols, next_hrs):
+    """Predict the rows of ``df`` as a row of targets each"""
+    return predict_frame(model, df, cols).reshape(len(df), len(next_hrs))
+
+
+def backtest_model(
+    model, holdout, cols, next_hrs, cat_features=None, sample=None, n_jobs=-1
+):
+    """
+    Evaluate the model on the holdout rows of ``split_holdout``.
+
+    Parameters:
+    cat_features (list): Categorical features the model was trained with, to
+                         report the metrics of every category of targets.
+    sample (int): Amount of holdout rows to evaluate on, all of them if
+                  ``None``.
+    n_jobs (int): Amount of processes predicting the rows, ``-1`` uses every
+                  core.
+
+    Returns:
+    dict: R^2 and MAE of all targets, of every horizon and of every category.
+    """
+    if holdout.empty:
+        logger.info("No holdout rows to backtest the model on")
+        return {"rows": 0}
+    if sample and len(holdout) > sample:
+        holdout = holdout.sample(sample, random_state=0)
+
+    chunks = np.array_split(
+        np.arange(len(holdout)), max(effective_n_jobs(n_jobs), 1)
+    )
+    y_pred = np.vstack(
+        Parallel(n_jobs=n_jobs, max_nbytes="1M", mmap_mode="r")(
+            delayed(predict_rows)(model, holdout.iloc[rows], cols, next_hrs)
+            for rows in chunks
+            if len(rows)
+        )
+    )
+    y_true = holdout[next_hrs].to_numpy(dtype=np.float64)
+
+    categories = np.array(
+        [target_category(target, cat_features or []) for target in next_hrs],
+        dtype=object,
+    )
+    horizons = np.array([target_horizon(target) for target in next_hrs])
+
+    metrics = {
+        "rows": len(holdout),
+        "all": score(y_true, y_pred),
+        "horizons": {
+            f"next_{horizon}_hour": score(
+                y_true[:, horizons == horizon], y_pred[:, horizons == horizon]
+            )
+            for horizon in dict.fromkeys(horizons.tolist())
+        },
+        "categories": {
+            category: score(
+                y_true[:, categories == category],
+                y_pred[:, categories == category],
+            )
+            for category in dict.fromkeys(categories.tolist())
+        },
+    }
+    logger.info(
+        f"Backtest on {metrics['rows']} rows: "
+        f"R^2 {metrics['all']['r2']:.3f}, MAE {metrics['all']['mae']:.3f}"
+    )
+    for horizon, horizon_metrics in metrics["horizons"].items():
+        logger.info(
+            f"{horizon}: R^2 {horizon_metrics['r2']:.3f}, "
+            f"MAE {horizon_metrics['mae']:.3f}"
+        )
+    return metrics
@@ -1,9 +1,16 @@
-import pandas as pd
+import hashlib
 import numpy as np
-from constants import columns, date_col, agg_cols
-from sqlite.utils import fetch_model
+import pandas as pd
+from constants import date_col
+from scipy import sparse
+from sqlite.utils import fetch_model, load_feature_pipeline
+from data.serialisation import build_target_layout
+from data.feature_pipeline import FeaturePipeline
+from models.bundle import PidModelBundle, predict_matrix
 from sqlite.client import sqlite_client
 from clickhouse.client import clickhouse_client
+from data.aggregation import aggregate_latest_hour, get_max_created
+from utils.instrumentation import stage
 from logging_config import setup_logger
 import json
 
@@ -24,18 +31,45 @@ insert new predictions
 """
 
 
-def get_projects_records() -> pd.DataFrame:
-    # query the clickhouse database to get historical data for all projects and predict future traffic for them
-    # temporary:
-    """Read the csv file with encodings and add columns to it"""
-    data = clickhouse_client.execute_query("SELECT * FROM analytics")
-    df = pd.DataFrame(data.result_rows, columns=columns)
+def get_projects_records(cat_features, pids=None) -> pd.DataFrame:
+    """
+    Query the events of the most recent hour of the analytics, null values are
+    replaced and date components are extracted by ClickHouse. The events are
+    fetched as Arrow columns, ``pid`` and the features as categoricals.
 
-    # Exclude specific columns
-    columns_to_exclude = ["meta.key", "meta.value"]
-    df = df.drop(columns=columns_to_exclude)
+    Parameters:
+    cat_features (list): Categorical features the model was trained with.
+    pids (list): Only query these pids, all of them if ``None``.
 
-    return df
+    Returns:
+    pd.DataFrame: The events with ``agg_cols`` and the categorical features.
+    """
+    features = ", ".join(
+        f"toLowCardinality(nullIf(toString(`{col}`), '\\\\N')) AS `{col}`"
+        for col in cat_features
+    )
+    query = f"""
+    SELECT
+        toYear({date_col}) AS year,
+        toMonth({date_col}) AS month,
+        toDayOfMonth({date_col}) AS day,
+        toDayOfWeek({date_col}) - 1 AS day_of_week,
+        toHour({date_col}) AS hour,
+        toLowCardinality(pid) AS pid,
+        {features}
+    FROM analytics
+    WHERE {date_col} >= %(hour)s
+        AND {date_col} < toDateTime(%(hour)s) + INTERVAL 1 HOUR
+        {"AND pid IN %(pids)s" if pids is not None else ""}
+    """
+    hour = get_max_created().floor("h")
+    return clickhouse_client.query_frame(
+        query,
+        parameters={
+            "hour": hour.to_pydatetime(),
+            "pids": tuple(pids) if pids is not None else None,
+        },
+    )
 
 
 def get_variable_from_tmp(var_name: str):
@@ -50,118 +84,133 @@ def get_variable_from_tmp(var_name: str):
     return None
 
 
-def preprocess_data(df, date_col):
-    """
-    Preprocesses the data by sorting, replacing null values, converting date column to datetime, and extracting date components.
-
-    Parameters:
-    df (pd.DataFrame): The input DataFrame.
-    date_col (str): The name of the date column.
-
-    Returns:
-    pd.DataFrame: The preprocessed DataFrame.
-    """
-    # Sort the DataFrame by the date column
-    df = df.sort_values(date_col)
-
-    # Replace "\\N" with NaN
-    df = df.replace({"\\N": np.nan})
-
-    # Convert the date column to datetime
-    df[date_col] = pd.to_datetime(df[date_col])
-
-    # Extract date components
-    df["year"] = df[date_col].dt.year
-    df["month"] = df[date_col].dt.month
-    df["day"] = df[date_col].dt.day
-    df["day_of_week"] = df[date_col].dt.dayofweek
-    df["hour"] = df[date_col].dt.hour
-
-    return df
-
-
-def filter_most_recent_hour(df, date_col):
+def get_training_shards():
     """
-    Filters the DataFrame to keep only the rows corresponding to the most recent hour.
-
-    Parameters:
-    df (pd.DataFrame): The input DataFrame.
-    date_col (str): The name of the date column.
-
-    Returns:
-    pd.DataFrame: The DataFrame filtered to the most recent hour.
+    Get the trained shards from training_tmp table, every shard has its own
+    features, model, target layout and vocabularies, and the pids it was
+    trained with (``None`` if the model was trained with the most frequent
+    pids)
     """
-    # Determine the most recent values for year, month, day, and hour
-    for col in ["year", "month", "day", "hour"]:
-        df = df[df[col] == df.tail(1)[col].values[0]]
-
-    # Drop the original date column
-    df.drop([date_col], axis=1, inplace=True)
-
-    return df
-
-
-def encode_and_aggregate(df, cat_features, agg_cols):
+    result = sqlite_client.execute_query(
+        "SELECT cat_features, cols, next_hrs, model_path, pids, target_layout, "
+        "vocabularies FROM training_tmp"
+    )
+    shards = []
+    for row in result:
+        cat_features, cols, next_hrs, model_path, pids, layout = row[:6]
+        vocabularies = row[6]
+        cat_features = json.loads(cat_features)
+        next_hrs = json.loads(next_hrs)
+        shards.append(
+            {
+                "cat_features": cat_features,
+                "cols": json.loads(cols),
+                "next_hrs": next_hrs,
+                "model_path": model_path,
+                "pids": json.loads(pids) if pids else None,
+                # Models trained before the layout was stored
+                "target_layout": (
+                    json.loads(layout)
+                    if layout
+                    else build_target_layout(next_hrs, cat_features)
+                ),
+                # Models trained with the features over the threshold dropped
+                "vocabularies": (
+                    json.loads(vocabularies) if vocabularies else None
+                ),
+            }
+        )
+    return shards
+
+
+def input_digests(X):
     """
-    Encodes categorical features, aggregates the data, and fills missing values.
-
-    Parameters:
-    df (pd.DataFrame): The input DataFrame.
-    cat_features (list): List of categorical features to be one-hot encoded.
-    agg_cols (list): List of columns to group by when aggregating data.
-
-    Returns:
-    pd.DataFrame: The aggregated DataFrame with encoded categorical features and missing values filled.
+    Digest of the feature vector of every row of the feature matrix ``X``,
+    the features which are zero do not change the digest
     """
-    # Add a column for traffic
-    df["traffic"] = 1
-
-    # One-hot encode the categorical features
-    df = pd.get_dummies(df, columns=cat_features, dtype="int")
-
-    # Aggregate data by summing up the traffic
-    df = df.groupby(agg_cols).sum().reset_index()
-
-    # Fill NaN values with 0
-    df = df.fillna(0)
-
-    return df
-
-
-def fill_missing_columns(df, all_cols):
+    X = sparse.csr_matrix(X, dtype=np.float32)
+    X.sum_duplicates()
+    X.eliminate_zeros()
+    return [
+        hashlib.blake2b(
+            X.indices[start:end].tobytes() + X.data[start:end].tobytes(),
+            digest_size=16,
+        ).hexdigest()
+        for start, end in zip(X.indptr[:-1], X.indptr[1:])
+    ]
+
+
+def predict_future_data(ingestion="memory", shard=None, digests=None):
     """
-    Fills missing columns in the DataFrame with 0.
+    Pre-processing of data
 
     Parameters:
-    df (pd.DataFrame): The input DataFrame.
-    all_cols (list): List of all possible columns.
+    ingestion (str): ``memory`` counts the most recent hour with the
+                     feature pipeline of the model, ``clickhouse``
+                     aggregates the most recent hour inside ClickHouse and
+                     ``rollup`` reads it from the ``analytics_hourly`` rollup
+                     table.
+    shard (dict): The trained shard from ``get_training_shards`` to predict
+                  the pids of, the first one if ``None``.
+    digests (dict): Input digest of every pid predicted by the previous run
+                    with the model of the shard, the pids whose input did
+                    not change are not predicted again.
 
     Returns:
-    pd.DataFrame: The DataFrame with missing columns filled with 0.
+    list: The predicted pids.
+    np.ndarray: The model output of every pid, with a column per target.
+    list: The input digest of every predicted pid.
     """
-    missing_cols = [x for x in all_cols if x not in df.columns]
-    df[missing_cols] = 0
-
-    return df
-
-
-def predict_future_data():
-    """Pre-processing of data"""
-    cat_features = json.loads(get_variable_from_tmp("cat_features"))
-    cols = json.loads(get_variable_from_tmp("cols"))
-    next_hrs = json.loads(get_variable_from_tmp("next_hrs"))
-    model_path = get_variable_from_tmp("model_path")
-
-    model = fetch_model(model_path)
-
-    df = get_projects_records()
-    df = preprocess_data(df, date_col)
-    df = filter_most_recent_hour(df, date_col)
-    df = encode_and_aggregate(df, cat_features, agg_cols)
-    df = fill_missing_columns(df, cols)
-
-    y = pd.DataFrame(model.predict(df[cols]), columns=next_hrs)
-    y["pid"] = df["pid"]
-    y = y.set_index("pid").reset_index()
-
-    return y.to_json(orient="records")
+    shard = shard or get_training_shards()[0]
+    cat_features = shard["cat_features"]
+    cols = shard["cols"]
+    next_hrs = shard["next_hrs"]
+    pids = shard["pids"]
+
+    with stage("predict_future_data.load_model"):
+        model = fetch_model(shard["model_path"])
+        # Models trained before the pipeline was saved with them
+        pipeline = load_feature_pipeline(
+            shard["model_path"]
+        ) or FeaturePipeline.from_columns(cols, cat_features)
+
+    with stage("predict_future_data.load") as current:
+        if ingestion == "memory":
+            keys, X = pipeline.transform(
+                get_projects_records(cat_features, pids)
+            )
+        elif ingestion in ("clickhouse", "rollup"):
+            keys, X = pipeline.transform_counts(
+                aggregate_latest_hour(
+                    cat_features, cols, rollup=ingestion == "rollup", pids=pids
+                )
+            )
+        else:
+            raise ValueError(f"Unknown ingestion mode: {ingestion}")
+        current.shape(X)
+    row_pids = keys["pid"].to_numpy()
+
+    if isinstance(model, PidModelBundle):
+        known = np.isin(row_pids, list(model.models))
+        logger.info(f"Skipped {(~known).sum()} pids without a trained model")
+        X, row_pids = X[known], row_pids[known]
+
+    with stage("predict_future_data.digests") as current:
+        X_digests = np.array(input_digests(X), dtype=object)
+        if digests:
+            changed = X_digests != pd.Series(row_pids).map(digests).to_numpy()
+            logger.info(f"Skipped {(~changed).sum()} pids with the same input")
+            X, row_pids = X[changed], row_pids[changed]
+            X_digests = X_digests[changed]
+        current.shape(X)
+
+    if not len(X):
+        logger.info("No changed traffic of the pids in the most recent hour")
+        return [], np.empty((0, len(next_hrs))), []
+
+    with stage("predict_future_data.predict") as current:
+        y = predict_matrix(model, X, row_pids, cols).reshape(
+            len(X), len(next_hrs)
+        )
+        current.shape(y)
+    return row_pids.tolist(), y, X_digests.tolist()
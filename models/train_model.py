@@ -1,12 +1,95 @@
+import time
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
 from sklearn.tree import DecisionTreeRegressor
-from models.evaluate_model import evaluate_model
+from models.bundle import PidModelBundle, has_sparse_features, feature_matrix
+from models.evaluate_model import evaluate_model, target_horizon
+from utils.instrumentation import stage
+from logging_config import setup_logger
 
+logger = setup_logger("train_model")
 
-def train_model(df, cols, next_hrs):
+
+def fit_pid_model(X, y, rows):
+    """Fit the model of a single pid on its ``rows`` of the shared arrays"""
+    model = DecisionTreeRegressor()
+    model.fit(X[rows], y[rows])
+    return model
+
+
+def train_pid_models(df, cols, next_hrs, n_jobs=-1):
+    """
+    Fit an independent model for every pid on a pool of processes.
+
+    The features and targets are converted once to the dtypes the trees are
+    fitted with and ``joblib`` memory-maps them for the workers, so every
+    worker only copies the rows of its pid. Sparse features are passed as a
+    CSR matrix.
+
+    Returns:
+    PidModelBundle: The models of every pid.
+    """
+    if has_sparse_features(df, cols):
+        X = feature_matrix(df, cols)
+    else:
+        X = df[cols].to_numpy(dtype=np.float32)
+    y = df[next_hrs].to_numpy(dtype=np.float64)
+
+    codes, pids = pd.factorize(df["pid"])
+    order = np.argsort(codes, kind="stable")
+    groups = np.split(order, np.cumsum(np.bincount(codes))[:-1])
+
+    models = Parallel(n_jobs=n_jobs, max_nbytes="1M", mmap_mode="r")(
+        delayed(fit_pid_model)(X, y, rows) for rows in groups
+    )
+    return PidModelBundle(dict(zip(pids, models)), next_hrs)
+
+
+def train_model(df, cols, next_hrs, per_pid=False, n_jobs=-1, evaluate=True):
     """
     Train the model, fit data into the model and evaluate model's efficiency
+
+    Parameters:
+    per_pid (bool): Fit an independent model for every pid in parallel
+                    instead of a single model for all of them.
+    n_jobs (int): Amount of processes for the per pid models, ``-1`` uses
+                  every core.
+    evaluate (bool): Evaluate the model on the training rows, which predicts
+                     all of them again, ``backtest_model`` evaluates on held
+                     out rows instead.
     """
-    model = DecisionTreeRegressor()
-    model.fit(df[cols], df[next_hrs])
-    evaluate_model(model, df, cols, next_hrs)
+    if df.empty:
+        raise ValueError(
+            "No training rows, every pid has less hourly rows than the "
+            f"{max(target_horizon(target) for target in next_hrs)} hours of "
+            "the longest target horizon"
+        )
+
+    start = time.perf_counter()
+    with stage("train_model.fit") as current:
+        current.shape(df)
+        if per_pid:
+            model = train_pid_models(df, cols, next_hrs, n_jobs=n_jobs)
+        else:
+            model = DecisionTreeRegressor()
+            if has_sparse_features(df, cols):
+                # Trees split sparse matrices without densifying them
+                model.fit(feature_matrix(df, cols), df[next_hrs].to_numpy())
+            else:
+                model.fit(df[cols], df[next_hrs])
+    logger.info(
+        f"Trained {'per pid' if per_pid else 'single'} model in "
+        f"{time.perf_counter() - start:.1f}s"
+        + (
+            f", peak memory {current.peak_rss_mb:.0f} MB"
+            if current.peak_rss_mb is not None
+            else ""
+        )
+    )
+
+    if evaluate:
+        with stage("train_model.evaluate") as current:
+            current.shape(df)
+            evaluate_model(model, df, cols, next_hrs)
     return model
@@ -1,20 +1,112 @@
-from sqlite.utils import insert_predictions
-from models.predict_model import predict_future_data
+import os
+import pandas as pd
+from sqlite.utils import (
+    serialise_prediction_rows,
+    publish_prediction_rows,
+    upsert_prediction_rows,
+    load_prediction_digests,
+    prediction_columns,
+    prediction_input_columns,
+)
+from models.predict_model import predict_future_data, get_training_shards
 
+from utils.instrumentation import instrumented_run, stage
 from logging_config import setup_logger
 from datetime import datetime
 
 logger = setup_logger("run_prediction")
 
+shard_directory = os.getenv("PREDICTIONS_SHARD_DIR", "prediction_shards/")
+
+
+def incremental_prediction():
+    """
+    Only predict and publish the pids whose input or model changed. The input
+    includes the date components of the hour, so it only skips pids when the
+    predictions run more than once an hour, e.g. retried or triggered runs
+    """
+    return os.getenv("PREDICTION_INCREMENTAL", "false") == "true"
+
+
+def predict_shard(shard=None, index=0):
+    """
+    Predict the future data of the trained ``shard`` and save its serialised
+    rows of the predictions table, with the input digest of every pid
+
+    Returns:
+    str: Path of the saved rows.
+    """
+    with instrumented_run("prediction", index):
+        logger.info(f"Started prediction of shard {index}: {datetime.now()}")
+        shard = shard or get_training_shards()[0]
+        pids, y, digests = predict_future_data(
+            ingestion=os.getenv("PREDICTION_INGESTION", "memory"),
+            shard=shard,
+            digests=(
+                load_prediction_digests(shard["model_path"])
+                if incremental_prediction()
+                else None
+            ),
+        )
+        rows = serialise_prediction_rows(
+            pids,
+            y,
+            shard["target_layout"],
+            compress=os.getenv("PREDICTIONS_RESPONSE_GZIP", "false") == "true",
+        )
+
+        os.makedirs(shard_directory, exist_ok=True)
+        path = os.path.join(
+            shard_directory,
+            f'predictions_{datetime.now().strftime("%Y%m%d_%H%M%S")}_{index}'
+            ".parquet",
+        )
+        with stage("save_prediction_rows"):
+            df = pd.DataFrame(rows, columns=prediction_columns)
+            df["digest"] = digests
+            df["model_path"] = shard["model_path"]
+            df.to_parquet(path)
+        return path
+
+
+def publish_predictions(paths, model_paths):
+    """
+    Insert the saved rows of every shard into the DB at once, either replacing
+    the predictions or upserting the changed pids. The ``model_paths`` are
+    the models the shards were predicted with, read when the run started, as
+    the training may publish new models while the run is in flight.
+    """
+    with instrumented_run("publish_predictions"):
+        with stage("load_prediction_rows") as current:
+            df = pd.concat(
+                [pd.read_parquet(path) for path in paths], ignore_index=True
+            )
+            df = current.shape(df.astype(object).where(df.notna(), None))
+        rows = list(df[prediction_columns].itertuples(index=False, name=None))
+        inputs = list(
+            df[prediction_input_columns].itertuples(index=False, name=None)
+        )
+
+        if incremental_prediction():
+            upsert_prediction_rows(rows, inputs, model_paths)
+        else:
+            publish_prediction_rows(rows, inputs)
+        for path in paths:
+            os.remove(path)
+
+        logger.info(
+            "Prediction has been completed, removing previous records from "
+            f"the database and insert new {datetime.now()}"
+        )
+
 
 def predict():
     """Celery task which is called for a model predictions
-    - Predicts the future data
+    - Predicts the future data of every trained shard
     - Inserts serialised predictions into the DB
     """
-    logger.info(f"Started prediction of the data: {datetime.now()}")
-    predictions = predict_future_data()
-    insert_predictions(predictions)
-    logger.info(
-        f"Prediction has been completed, removing previous records from the database and insert new {datetime.now()}"
+    shards = get_training_shards()
+    publish_predictions(
+        [predict_shard(shard, index) for index, shard in enumerate(shards)],
+        [shard["model_path"] for shard in shards],
     )
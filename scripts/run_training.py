@@ -1,63 +1,195 @@
 import sys
 import os
 import json
+import pandas as pd
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from sqlite.client import sqlite_client
 from sqlite.utils import (
-    serialize_model,
-    save_model_to_file,
+    save_model,
     remove_existing_models,
 )
+from data import aggregation
+from data.feature_store import FeatureStore
 from data.load_data import pre_process_data
+from data.serialisation import build_target_layout
+from data.vocabulary import vocabularies_from_columns
 from models.train_model import train_model
+from models.evaluate_model import split_holdout, backtest_model
+from utils.instrumentation import instrumented_run, stage
 from logging_config import setup_logger
 from datetime import datetime
 
 logger = setup_logger("run_training")
 
+model_directory = "trained_models/"
 
-def train():
-    """Celery task which is called for a model training
-    - Gets data from ``load_data`` module
-    - Serialises model to ``base64`` encoding
-    - Inserts data to the DB
+
+def plan_training_shards(shard_size, time_delta_years=1):
+    """
+    Split every pid with events within the training window into shards of at
+    most ``shard_size`` pids. The pids are dealt by their amount of events, so
+    every shard gets a similar share of the traffic.
     """
+    start_date = aggregation.get_max_created() - pd.DateOffset(
+        years=time_delta_years
+    )
+    pids = aggregation.get_most_frequent_pids(start_date, project_amount=None)
+    if os.getenv("TRAINING_INGESTION", "memory") == "feature_store":
+        # The shards only drop the partitions of their own pids, the pids
+        # without events in the training window are dropped once here
+        FeatureStore().drop_partitions_before(
+            start_date.floor("h") + pd.Timedelta(hours=1)
+        )
+    shards = -(-len(pids) // shard_size)
+    logger.info(f"Split {len(pids)} pids into {shards} training shards")
+    return [pids[shard::shards] for shard in range(shards)]
 
-    model_directory = "trained_models/"
-    remove_existing_models(model_directory)
 
-    logger.info(f"Start training the model {datetime.now()}")
-    df, cat_features, cols, next_hrs = pre_process_data()
-    model = train_model(df, cols, next_hrs)
+def train_shard(pids=None, shard=0):
+    """Train and save the model of the ``pids``, the most frequent if ``None``
 
-    serialized_model = serialize_model(model)
+    Returns:
+    dict: The row of the shard for training_tmp table.
+    """
+    with instrumented_run("training", shard):
+        logger.info(
+            f"Start training the model of shard {shard} {datetime.now()}"
+        )
+        # 0 keeps the categorical features under the cardinality threshold
+        vocabulary_size = int(os.getenv("TRAINING_VOCABULARY_SIZE", 0)) or None
+        # 0 trains with every project
+        project_amount = int(os.getenv("TRAINING_PROJECT_AMOUNT", 15)) or None
+        df, cat_features, cols, next_hrs, pipeline = pre_process_data(
+            ingestion=os.getenv("TRAINING_INGESTION", "memory"),
+            project_amount=project_amount,
+            compact=os.getenv("TRAINING_COMPACT_DTYPES", "false") == "true",
+            pids=pids,
+            sparse=os.getenv("TRAINING_SPARSE_FEATURES", "false") == "true",
+            threshold=int(os.getenv("TRAINING_CARDINALITY_THRESHOLD", 300)),
+            vocabulary_size=vocabulary_size,
+        )
+        # in_sample | backtest | none
+        evaluation = os.getenv("TRAINING_EVALUATION", "in_sample")
+        n_jobs = int(os.getenv("TRAINING_N_JOBS", -1))
+        per_pid = os.getenv("TRAINING_MODE", "single") == "per_pid"
+        metrics = None
+        if evaluation == "backtest":
+            with stage("split_holdout") as current:
+                train_df, holdout = split_holdout(
+                    df,
+                    next_hrs,
+                    hours=int(os.getenv("TRAINING_HOLDOUT_HOURS", 24)),
+                )
+                current.shape(holdout)
+            # The model trained without the holdout is served, unless it is
+            # fitted again on every row
+            refit = os.getenv("TRAINING_BACKTEST_REFIT", "false") == "true"
+            if not refit:
+                del df
 
-    model_name = f'model_{datetime.now().strftime("%Y%m%d_%H%M%S")}.pkl'
-    model_path = save_model_to_file(
-        serialized_model.encode(), model_directory, model_name
-    )
-    logger.info(f"Model saved to {model_path}")
+        model = train_model(
+            train_df if evaluation == "backtest" else df,
+            cols,
+            next_hrs,
+            per_pid=per_pid,
+            n_jobs=n_jobs,
+            evaluate=evaluation == "in_sample",
+        )
 
-    training_tmp_data = [
-        (
-            json.dumps(cat_features),
-            json.dumps(cols.tolist()),
-            json.dumps(next_hrs),
-            model_path,
+        if evaluation == "backtest":
+            metrics = {"rows": 0}
+            if not holdout.empty:
+                with stage("backtest_model") as current:
+                    metrics = backtest_model(
+                        model,
+                        holdout,
+                        cols,
+                        next_hrs,
+                        cat_features=cat_features,
+                        sample=int(os.getenv("TRAINING_BACKTEST_SAMPLE", 0))
+                        or None,
+                        n_jobs=n_jobs,
+                    )
+                    current.rows = metrics["rows"]
+            del train_df, holdout
+            if refit:
+                del model
+                model = train_model(
+                    df,
+                    cols,
+                    next_hrs,
+                    per_pid=per_pid,
+                    n_jobs=n_jobs,
+                    evaluate=False,
+                )
+
+        os.makedirs(model_directory, exist_ok=True)
+        model_name = (
+            f'model_{datetime.now().strftime("%Y%m%d_%H%M%S")}_{shard}.joblib'
         )
-    ]
+        with stage("save_model"):
+            model_path = save_model(
+                model,
+                model_directory,
+                model_name,
+                metrics=metrics,
+                pipeline=pipeline,
+            )
+        logger.info(f"Model saved to {model_path}")
+
+        return {
+            "cat_features": json.dumps(cat_features),
+            "cols": json.dumps(list(cols)),
+            "next_hrs": json.dumps(next_hrs),
+            "model_path": model_path,
+            "pids": json.dumps(pids) if pids is not None else None,
+            "target_layout": json.dumps(
+                build_target_layout(next_hrs, cat_features)
+            ),
+            "vocabularies": (
+                json.dumps(vocabularies_from_columns(cols, cat_features))
+                if vocabulary_size is not None
+                else None
+            ),
+        }
 
-    # Drop previous(not relevant) data before the insertion of new training data
-    sqlite_client.drop_all_data_from_table("training_tmp")
 
-    sqlite_client.insert_data(
+def publish_training(shards):
+    """Make the trained ``shards`` live and remove the previous models"""
+    column_names = [
+        "cat_features",
+        "cols",
+        "next_hrs",
+        "model_path",
+        "pids",
+        "target_layout",
+        "vocabularies",
+    ]
+    training_tmp_data = [
+        tuple(shard[column] for column in column_names) for shard in shards
+    ]
+
+    # Replace previous(not relevant) training data in a single transaction
+    sqlite_client.replace_table_data(
         table="training_tmp",
         data=training_tmp_data,
-        column_names=["cat_features", "cols", "next_hrs", "model_path"],
+        column_names=column_names,
+    )
+    remove_existing_models(
+        model_directory, keep=[shard["model_path"] for shard in shards]
     )
 
     logger.info(
         f"Training has been completed, removing previous records from the database and insert new {datetime.now()}"
     )
+
+
+def train():
+    """Celery task which is called for a model training
+    - Gets data from ``load_data`` module
+    - Saves model with ``joblib``
+    - Inserts data to the DB
+    """
+    publish_training([train_shard()])
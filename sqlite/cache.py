@@ -0,0 +1,65 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from sqlite.client import sqlite_client
+
+
+class PredictionsCache:
+    """
+    In-memory LRU cache with a TTL for the predictions served by the API.
+
+    The cache is cleared as soon as a new prediction run is published, which
+    is checked by the latest id of the ``prediction_runs`` table at most once
+    per ``version_check_interval`` seconds, so the API process notices runs
+    published by the Celery workers.
+    """
+
+    def __init__(self, maxsize=None, ttl=None, version_check_interval=1.0):
+        load_dotenv()
+        self.maxsize = maxsize or int(
+            os.getenv("PREDICTIONS_CACHE_SIZE", 10000)
+        )
+        self.ttl = ttl or float(os.getenv("PREDICTIONS_CACHE_TTL", 300))
+        self.version_check_interval = version_check_interval
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = 0.0
+
+    def _check_version(self):
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_check_interval:
+            return
+        self._version_checked_at = now
+
+        result = sqlite_client.execute_query(
+            "SELECT MAX(id) FROM prediction_runs"
+        )
+        version = result[0][0] if result else None
+        if version != self._version:
+            self._items.clear()
+            self._version = version
+
+    def get_or_load(self, key, load):
+        """Return the cached value of ``key``, or load and cache it"""
+        with self._lock:
+            self._check_version()
+            item = self._items.get(key)
+            if item is not None and item[0] > time.monotonic():
+                self._items.move_to_end(key)
+                return item[1]
+
+        value = load(key)
+
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
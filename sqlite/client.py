@@ -1,4 +1,5 @@
 import os
+import re
 import sqlite3
 from dotenv import load_dotenv
 
@@ -12,10 +13,10 @@ class SQLiteClient:
         """Create a new database connection."""
         return sqlite3.connect(self.db_path)
 
-    def execute_query(self, query: str):
+    def execute_query(self, query: str, parameters: tuple = ()):
         with self._get_connection() as connection:
             cursor = connection.cursor()
-            cursor.execute(query)
+            cursor.execute(query, parameters)
             result = cursor.fetchall()
             connection.commit()
         return result
@@ -29,6 +30,62 @@ class SQLiteClient:
             cursor.executemany(query, data)
             connection.commit()
 
+    def upsert_data(self, table: str, data: list, column_names: list):
+        """Insert the rows, replacing the rows with the same primary key"""
+        placeholders = ", ".join("?" for _ in column_names)
+        columns = ", ".join(column_names)
+        query = (
+            f"INSERT OR REPLACE INTO {table} ({columns}) "
+            f"VALUES ({placeholders})"
+        )
+        with self._get_connection() as connection:
+            cursor = connection.cursor()
+            cursor.executemany(query, data)
+            connection.commit()
+
+    def replace_table_data(self, table: str, data: list, column_names: list):
+        """
+        Replace all rows of the table atomically. The rows are written to a
+        staging copy of the table, which takes the place of the table in the
+        same transaction, so in WAL mode readers are not blocked and keep
+        reading the previous rows until the commit.
+        """
+        staging_table = f"{table}_staging"
+        placeholders = ", ".join("?" for _ in column_names)
+        columns = ", ".join(column_names)
+        query = (
+            f"INSERT INTO {staging_table} ({columns}) VALUES ({placeholders})"
+        )
+
+        connection = self._get_connection()
+        connection.isolation_level = None
+        try:
+            cursor = connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            (schema,) = cursor.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' "
+                "AND name = ?",
+                (table,),
+            ).fetchone()
+            cursor.execute(f"DROP TABLE IF EXISTS {staging_table}")
+            cursor.execute(
+                re.sub(
+                    r"^CREATE TABLE\s+(\"?)\w+\1",
+                    f'CREATE TABLE "{staging_table}"',
+                    schema,
+                )
+            )
+            cursor.executemany(query, data)
+            cursor.execute(f"DROP TABLE {table}")
+            cursor.execute(f"ALTER TABLE {staging_table} RENAME TO {table}")
+            cursor.execute("COMMIT")
+        except Exception:
+            if connection.in_transaction:
+                connection.rollback()
+            raise
+        finally:
+            connection.close()
+
     def drop_all_data_from_table(self, table_name: str):
         query = f"DELETE FROM {table_name}"
         self.execute_query(query)
@@ -1,15 +1,34 @@
 from client import SQLiteClient
 
 
+def add_missing_columns(client, table, columns):
+    """Add the ``columns`` to a table which was created before them"""
+    existing_columns = [
+        column[1]
+        for column in client.execute_query(f"PRAGMA table_info({table})")
+    ]
+    for column, column_type in columns:
+        if column not in existing_columns:
+            client.execute_query(
+                f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"
+            )
+
+
 def create_tables():
     client = SQLiteClient()
 
+    # Readers are not blocked by the publication of new predictions
+    client.execute_query("PRAGMA journal_mode=WAL")
+
     training_tmp_query = """
     CREATE TABLE IF NOT EXISTS training_tmp (
         cat_features TEXT,
         cols TEXT,
         next_hrs TEXT,
-        model_path TEXT
+        model_path TEXT,
+        pids TEXT,
+        target_layout TEXT,
+        vocabularies TEXT
     )
     """
 
@@ -22,12 +41,86 @@ def create_tables():
         next_12_hour TEXT,
         next_24_hour TEXT,
         next_72_hour TEXT,
-        next_168_hour TEXT
+        next_168_hour TEXT,
+        response BLOB,
+        content_encoding TEXT
+    )
+    """
+
+    prediction_inputs_query = """
+    CREATE TABLE IF NOT EXISTS prediction_inputs (
+        pid TEXT PRIMARY KEY,
+        digest TEXT,
+        model_path TEXT
+    )
+    """
+
+    prediction_runs_query = """
+    CREATE TABLE IF NOT EXISTS prediction_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """
+
+    run_reports_query = """
+    CREATE TABLE IF NOT EXISTS run_reports (
+        run_id TEXT PRIMARY KEY,
+        run_type TEXT,
+        shard INTEGER,
+        started_at TEXT,
+        finished_at TEXT,
+        wall_seconds REAL,
+        status TEXT
+    )
+    """
+
+    run_report_stages_query = """
+    CREATE TABLE IF NOT EXISTS run_report_stages (
+        run_id TEXT,
+        stage TEXT,
+        position INTEGER,
+        status TEXT,
+        wall_seconds REAL,
+        cpu_seconds REAL,
+        peak_rss_mb REAL,
+        tracemalloc_peak_mb REAL,
+        rows INTEGER,
+        columns INTEGER
+    )
+    """
+
+    task_locks_query = """
+    CREATE TABLE IF NOT EXISTS task_locks (
+        task TEXT PRIMARY KEY,
+        run_id TEXT,
+        started_at TEXT,
+        expires_at TEXT,
+        shards INTEGER
     )
     """
 
     client.execute_query(training_tmp_query)
     client.execute_query(predictions_query)
+    client.execute_query(prediction_inputs_query)
+    client.execute_query(prediction_runs_query)
+    client.execute_query(run_reports_query)
+    client.execute_query(run_report_stages_query)
+    client.execute_query(task_locks_query)
+
+    add_missing_columns(
+        client,
+        "training_tmp",
+        [
+            ("pids", "TEXT"),
+            ("target_layout", "TEXT"),
+            ("vocabularies", "TEXT"),
+        ],
+    )
+    add_missing_columns(
+        client,
+        "predictions",
+        [("response", "BLOB"), ("content_encoding", "TEXT")],
+    )
 
 
 if __name__ == "__main__":
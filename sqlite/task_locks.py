@@ -0,0 +1,110 @@
+import os
+import uuid
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from sqlite.client import sqlite_client
+
+"""
+Single-flight locks of the training and prediction runs.
+
+A run holds the lock of its task (``training`` or ``prediction``) in the
+``task_locks`` table from the trigger until its results are published, so a
+second trigger, either from the API or from Celery beat, does not start
+another run. A lock which is not released, e.g. because the worker was
+killed, expires after ``TASK_LOCK_TTL`` seconds.
+
+The progress of a run is the amount of its shards with a report in
+``run_reports`` (see ``utils.instrumentation``).
+"""
+
+load_dotenv()
+lock_ttl = float(os.getenv("TASK_LOCK_TTL", 6 * 3600))
+
+
+def acquire_task_lock(task, ttl=None):
+    """
+    Take the lock of the ``task`` and return the id of the new run, ``None``
+    is returned if another run holds the lock
+    """
+    started_at = datetime.now()
+    expires_at = started_at + timedelta(seconds=ttl or lock_ttl)
+    run_id = (
+        f"{task}_{started_at.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    )
+
+    # The conflicting row is only replaced once it is expired, in a single
+    # statement, so two triggers can not both take the lock
+    result = sqlite_client.execute_query(
+        """
+        INSERT INTO task_locks (task, run_id, started_at, expires_at, shards)
+        VALUES (?, ?, ?, ?, NULL)
+        ON CONFLICT(task) DO UPDATE SET
+            run_id = excluded.run_id,
+            started_at = excluded.started_at,
+            expires_at = excluded.expires_at,
+            shards = NULL
+        WHERE task_locks.expires_at < excluded.started_at
+        RETURNING run_id
+        """,
+        (task, run_id, started_at.isoformat(), expires_at.isoformat()),
+    )
+    return result[0][0] if result else None
+
+
+def set_task_shards(task, run_id, shards):
+    """Record the amount of shards of the run, to report its progress"""
+    sqlite_client.execute_query(
+        "UPDATE task_locks SET shards = ? WHERE task = ? AND run_id = ?",
+        (shards, task, run_id),
+    )
+
+
+def release_task_lock(task, run_id):
+    """Release the lock, only if it is still held by the ``run_id``"""
+    sqlite_client.execute_query(
+        "DELETE FROM task_locks WHERE task = ? AND run_id = ?",
+        (task, run_id),
+    )
+
+
+def get_task_lock(task):
+    """Return the run holding the lock of the ``task``, if it is not expired"""
+    result = sqlite_client.execute_query(
+        "SELECT run_id, started_at, expires_at, shards FROM task_locks "
+        "WHERE task = ? AND expires_at >= ?",
+        (task, datetime.now().isoformat()),
+    )
+    if not result:
+        return None
+
+    run_id, started_at, expires_at, shards = result[0]
+    return {
+        "run_id": run_id,
+        "started_at": started_at,
+        "expires_at": expires_at,
+        "shards": shards,
+    }
+
+
+def task_status(task):
+    """Report the run in progress of the ``task`` or its latest finished run"""
+    lock = get_task_lock(task)
+    if lock is None:
+        result = sqlite_client.execute_query(
+            "SELECT MAX(finished_at) FROM run_reports WHERE run_type = ?",
+            (task,),
+        )
+        return {"running": False, "last_finished_at": result[0][0]}
+
+    finished, failed = sqlite_client.execute_query(
+        "SELECT "
+        "COALESCE(SUM(status = 'ok'), 0), COALESCE(SUM(status != 'ok'), 0) "
+        "FROM run_reports WHERE run_type = ? AND started_at >= ?",
+        (task, lock["started_at"]),
+    )[0]
+    return {
+        "running": True,
+        **lock,
+        "finished_shards": finished,
+        "failed_shards": failed,
+    }
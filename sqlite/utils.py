@@ -2,11 +2,23 @@ import os
 import base64
 import pickle
 import json
+from functools import lru_cache
+import joblib
 from data.serialisation import (
     serialise_predictions,
+    serialise_prediction_array,
     serialise_data_for_sqlite,
+    timeframes,
 )
+from data.feature_pipeline import FeaturePipeline
 from sqlite.client import sqlite_client
+from utils.instrumentation import stage
+
+prediction_columns = ["pid", *timeframes, "response", "content_encoding"]
+prediction_input_columns = ["pid", "digest", "model_path"]
+# Models kept loaded by ``fetch_model``, a prediction run with training
+# shards uses a model per shard
+model_cache_size = int(os.getenv("MODEL_CACHE_SIZE", 32))
 
 
 """
@@ -17,6 +29,11 @@ Though it is a subject of discussion in the future. I personally prefer to store
 additional time for development which we do not have, as the priority is to test the model in production.
 """
 
+"""
+Models are saved with `joblib` without compression, so NumPy arrays of the model are stored as raw buffers and can be memory-mapped
+on load. Models saved as `base64` encoded pickles (`.pkl`) are still loaded for backward compatibility.
+"""
+
 
 def save_model_to_file(model, directory, model_name):
     file_path = os.path.join(directory, model_name)
@@ -43,39 +60,171 @@ def deserialize_model(base64_model):
     return model
 
 
-def fetch_model(model_path):
-    """Get the serialized model from the database for predictions"""
-    serialized_model = load_model_from_file(model_path)
-    model = deserialize_model(serialized_model.decode())
-    return model
+def save_model(model, directory, model_name, metrics=None, pipeline=None):
+    """
+    Save the model with ``joblib`` in the uncompressed format, its evaluation
+    ``metrics`` next to it as ``<model>.metrics.json`` and its feature
+    ``pipeline`` as ``<model>.pipeline.json``
+    """
+    file_path = os.path.join(directory, model_name)
+    joblib.dump(model, file_path)
+    if metrics is not None:
+        with open(f"{file_path}.metrics.json", "w") as metrics_file:
+            json.dump(metrics, metrics_file, indent=2)
+    if pipeline is not None:
+        pipeline.save(f"{file_path}.pipeline.json")
+    return file_path
+
 
+def load_model_metrics(model_path):
+    """Evaluation metrics saved with the model, ``None`` if there are none"""
+    metrics_path = f"{model_path}.metrics.json"
+    if not os.path.exists(metrics_path):
+        return None
+    with open(metrics_path) as metrics_file:
+        return json.load(metrics_file)
 
-def remove_existing_models(directory):
+
+def load_feature_pipeline(model_path):
+    """Feature pipeline saved with the model, ``None`` if there is none"""
+    pipeline_path = f"{model_path}.pipeline.json"
+    if not os.path.exists(pipeline_path):
+        return None
+    return FeaturePipeline.load(pipeline_path)
+
+
+@lru_cache(maxsize=model_cache_size)
+def _load_model(model_path, modified_time):
+    """Load the model, cached by the path and the modification time of the file"""
+    if model_path.endswith(".pkl"):
+        serialized_model = load_model_from_file(model_path)
+        return deserialize_model(serialized_model.decode())
+    return joblib.load(model_path, mmap_mode="r")
+
+
+def fetch_model(model_path):
+    """
+    Get the serialized model from the database for predictions, the loaded
+    model is reused by the process until the model file changes
+    """
+    return _load_model(model_path, os.path.getmtime(model_path))
+
+
+def remove_existing_models(directory, keep=()):
+    """
+    Remove the models of the directory with their metrics and pipelines,
+    except the ``keep`` paths
+    """
+    keep = {os.path.abspath(path) for path in keep}
     for filename in os.listdir(directory):
         file_path = os.path.join(directory, filename)
-        if os.path.isfile(file_path) and filename.endswith(".pkl"):
+        model_path = file_path.removesuffix(".metrics.json").removesuffix(
+            ".pipeline.json"
+        )
+        if os.path.abspath(model_path) in keep:
+            continue
+        if os.path.isfile(file_path) and model_path.endswith(
+            (".pkl", ".joblib")
+        ):
             os.remove(file_path)
 
 
-def insert_predictions(predictions):
-    """Insert serialised JSON data into the predictions table"""
-    predictions_data = json.loads(predictions)
-    processed_data = serialise_predictions(predictions_data)
-    serialized_data = serialise_data_for_sqlite(processed_data)
-
-    # Drop previous(not relevant) data before the insertion of new predictions
-    sqlite_client.drop_all_data_from_table("predictions")
-    sqlite_client.insert_data(
-        table="predictions",
-        data=serialized_data,
-        column_names=[
-            "pid",
-            "next_1_hour",
-            "next_4_hour",
-            "next_8_hour",
-            "next_12_hour",
-            "next_24_hour",
-            "next_72_hour",
-            "next_168_hour",
-        ],
+def serialise_prediction_rows(pids, y, layout, compress=False):
+    """
+    Serialise the model output of ``pids`` to the rows of the predictions
+    table with the target layout of the model, together with the
+    pre-rendered response of every pid, gzip compressed if ``compress``
+    """
+    with stage("insert_predictions.serialise") as current:
+        processed_data = serialise_prediction_array(pids, y, layout)
+        rows = serialise_data_for_sqlite(processed_data, compress)
+        current.shape(rows)
+    return rows
+
+
+def load_prediction_digests(model_path):
+    """Input digest of every pid predicted with the model of ``model_path``"""
+    return dict(
+        sqlite_client.execute_query(
+            "SELECT pid, digest FROM prediction_inputs WHERE model_path = ?",
+            (model_path,),
+        )
     )
+
+
+def publish_prediction_rows(rows, inputs=None):
+    """
+    Replace the predictions table with the serialised ``rows``, and the input
+    digests of the pids with ``inputs`` (``pid``, ``digest``, ``model_path``)
+    """
+    # Replace previous(not relevant) predictions in a single transaction
+    with stage("insert_predictions.publish") as current:
+        sqlite_client.replace_table_data(
+            table="predictions",
+            data=rows,
+            column_names=prediction_columns,
+        )
+        sqlite_client.replace_table_data(
+            table="prediction_inputs",
+            data=inputs or [],
+            column_names=prediction_input_columns,
+        )
+        current.shape(rows)
+
+    # Let the API know that the cached predictions are outdated
+    sqlite_client.execute_query("INSERT INTO prediction_runs DEFAULT VALUES")
+
+
+def upsert_prediction_rows(rows, inputs, model_paths):
+    """
+    Upsert the serialised ``rows`` of the pids whose input changed, together
+    with their input digests, and remove the predictions of the pids which
+    are not predicted by one of the ``model_paths`` of the run. These are
+    the models the rows were predicted with, not the models live at publish
+    time, which may already be newer.
+
+    The rows are written before their digests, so the pids of an interrupted
+    publication are predicted again by the next run.
+    """
+    with stage("insert_predictions.upsert") as current:
+        sqlite_client.upsert_data(
+            table="predictions", data=rows, column_names=prediction_columns
+        )
+        sqlite_client.upsert_data(
+            table="prediction_inputs",
+            data=inputs,
+            column_names=prediction_input_columns,
+        )
+
+        placeholders = ", ".join("?" for _ in model_paths)
+        removed = sqlite_client.execute_query(
+            "DELETE FROM predictions WHERE pid NOT IN "
+            "(SELECT pid FROM prediction_inputs "
+            f"WHERE model_path IN ({placeholders})) RETURNING pid",
+            tuple(model_paths),
+        )
+        sqlite_client.execute_query(
+            "DELETE FROM prediction_inputs "
+            f"WHERE model_path NOT IN ({placeholders})",
+            tuple(model_paths),
+        )
+        current.shape(rows)
+
+    if not rows and not removed:
+        return
+
+    # Let the API know that the cached predictions are outdated
+    sqlite_client.execute_query("INSERT INTO prediction_runs DEFAULT VALUES")
+
+
+def insert_predictions(predictions, compress=False):
+    """
+    Insert serialised JSON data into the predictions table, together with the
+    pre-rendered response of every pid, gzip compressed if ``compress``
+    """
+    with stage("insert_predictions.serialise") as current:
+        predictions_data = json.loads(predictions)
+        processed_data = serialise_predictions(predictions_data)
+        rows = serialise_data_for_sqlite(processed_data, compress)
+        current.shape(rows)
+    publish_prediction_rows(rows)
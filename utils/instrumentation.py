@@ -0,0 +1,318 @@
+import os
+import time
+import resource
+import tracemalloc
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlite.client import sqlite_client
+from logging_config import setup_logger
+
+logger = setup_logger("instrumentation")
+
+"""
+Instrumentation of the training and prediction runs.
+
+A run is opened by ``instrumented_run`` and every ``stage`` executed within it
+records its wall time, CPU time, peak RSS, tracemalloc peak (only with
+``INSTRUMENTATION_TRACEMALLOC=true``, as tracing slows the allocations down)
+and the rows and columns of its result. The peak RSS of a stage is measured
+by resetting the high-water mark of the process (``VmHWM``) when the stage
+starts, so it is not the peak of an earlier run of a long-lived worker; it
+is not recorded where ``/proc/self/clear_refs`` is not available. Stages
+outside of a run are not recorded. The report is saved to the
+``run_reports`` and ``run_report_stages`` tables when the run ends, even if
+it fails, and the latest run of every type is exposed by ``render_metrics``
+in the Prometheus text format.
+"""
+
+retention_days = 30
+
+_current_run = contextvars.ContextVar("instrumented_run", default=None)
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of the process and of its largest child in
+    megabytes, over the whole life of the processes
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of the process, ``False`` if not Linux"""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def current_peak_rss_mb():
+    """Peak resident memory in megabytes since the last ``reset_peak_rss``"""
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.columns = None
+        self.peak_rss_mb = None
+
+    def shape(self, result):
+        """Record the rows and columns of the DataFrame or array"""
+        shape = getattr(result, "shape", None) or (len(result),)
+        self.rows = shape[0]
+        self.columns = shape[1] if len(shape) > 1 else None
+        return result
+
+    def update_peak_rss(self, peak):
+        if peak is not None:
+            self.peak_rss_mb = max(self.peak_rss_mb or 0, peak)
+
+
+class RunReport:
+    def __init__(self, run_type, shard=None):
+        self.run_type = run_type
+        self.shard = shard
+        self.started_at = datetime.now()
+        self.run_id = (
+            f"{run_type}_{self.started_at.strftime('%Y%m%d_%H%M%S_%f')}"
+            f"_{shard if shard is not None else ''}"
+        )
+        self.stages = []
+        # Stages in progress, the inner ones last
+        self.open_stages = []
+
+    def save(self, status):
+        """Save the run and its stages, and drop the expired runs"""
+        finished_at = datetime.now()
+        sqlite_client.insert_data(
+            table="run_reports",
+            data=[
+                (
+                    self.run_id,
+                    self.run_type,
+                    self.shard,
+                    self.started_at.isoformat(),
+                    finished_at.isoformat(),
+                    (finished_at - self.started_at).total_seconds(),
+                    status,
+                )
+            ],
+            column_names=[
+                "run_id",
+                "run_type",
+                "shard",
+                "started_at",
+                "finished_at",
+                "wall_seconds",
+                "status",
+            ],
+        )
+        sqlite_client.insert_data(
+            table="run_report_stages",
+            data=[(self.run_id, *stage) for stage in self.stages],
+            column_names=[
+                "run_id",
+                "stage",
+                "position",
+                "status",
+                "wall_seconds",
+                "cpu_seconds",
+                "peak_rss_mb",
+                "tracemalloc_peak_mb",
+                "rows",
+                "columns",
+            ],
+        )
+
+        expired = (finished_at - timedelta(days=retention_days)).isoformat()
+        sqlite_client.execute_query(
+            "DELETE FROM run_report_stages WHERE run_id IN "
+            "(SELECT run_id FROM run_reports WHERE started_at < ?)",
+            (expired,),
+        )
+        sqlite_client.execute_query(
+            "DELETE FROM run_reports WHERE started_at < ?", (expired,)
+        )
+
+
+@contextmanager
+def instrumented_run(run_type, shard=None):
+    """Record the stages executed within the block as a run of ``run_type``"""
+    report = RunReport(run_type, shard)
+    token = _current_run.set(report)
+    trace = (
+        os.getenv("INSTRUMENTATION_TRACEMALLOC", "false") == "true"
+        and not tracemalloc.is_tracing()
+    )
+    if trace:
+        tracemalloc.start()
+
+    status = "error"
+    try:
+        yield report
+        status = "ok"
+    finally:
+        _current_run.reset(token)
+        if trace:
+            tracemalloc.stop()
+        try:
+            report.save(status)
+        except Exception:
+            logger.exception(f"Failed to save the report of {report.run_id}")
+        for name, _, stage_status, wall, cpu, rss, *_ in report.stages:
+            logger.info(
+                f"{report.run_id} {name}: {stage_status}, {wall:.2f}s wall, "
+                f"{cpu:.2f}s CPU"
+                + (f", peak RSS {rss:.0f} MB" if rss is not None else "")
+            )
+
+
+@contextmanager
+def stage(name):
+    """Record the block as a stage of the current run, if there is one"""
+    report = _current_run.get()
+    current = Stage(name)
+    if report is None:
+        yield current
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        traced = tracemalloc.get_traced_memory()[0]
+    # The stages in progress keep their peak so far before it is reset
+    peak = current_peak_rss_mb()
+    measured = reset_peak_rss()
+    if measured:
+        for open_stage in report.open_stages:
+            open_stage.update_peak_rss(peak)
+    report.open_stages.append(current)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+
+    status = "error"
+    try:
+        yield current
+        status = "ok"
+    finally:
+        report.open_stages.remove(current)
+        if measured:
+            peak = current_peak_rss_mb()
+            current.update_peak_rss(peak)
+            for open_stage in report.open_stages:
+                open_stage.update_peak_rss(peak)
+        report.stages.append(
+            (
+                name,
+                len(report.stages),
+                status,
+                time.perf_counter() - wall,
+                time.process_time() - cpu,
+                current.peak_rss_mb,
+                (
+                    (tracemalloc.get_traced_memory()[1] - traced) / 1024**2
+                    if tracing
+                    else None
+                ),
+                current.rows,
+                current.columns,
+            )
+        )
+
+
+stage_metrics = [
+    ("wall_seconds", "Wall time of the stage in seconds"),
+    ("cpu_seconds", "CPU time of the stage in seconds"),
+    ("peak_rss_mb", "Peak resident memory of the stage in megabytes"),
+    ("tracemalloc_peak_mb", "Peak traced allocations of the stage in MB"),
+    ("rows", "Rows of the stage result"),
+    ("columns", "Columns of the stage result"),
+]
+
+
+def format_labels(labels):
+    return ",".join(
+        f'{name}="{str(value)}"'
+        for name, value in labels.items()
+        if value is not None
+    )
+
+
+def render_metrics():
+    """
+    Render the latest run of every type and shard in the Prometheus text
+    exposition format
+    """
+    runs = sqlite_client.execute_query(
+        """
+        SELECT run_id, run_type, shard, started_at, wall_seconds, status
+        FROM run_reports AS r
+        WHERE started_at = (
+            SELECT MAX(started_at) FROM run_reports
+            WHERE run_type = r.run_type AND shard IS r.shard
+        )
+        ORDER BY run_type, shard
+        """
+    )
+    lines = [
+        "# HELP swetrix_run_wall_seconds Wall time of the latest run",
+        "# TYPE swetrix_run_wall_seconds gauge",
+    ]
+    run_labels = {}
+    for run_id, run_type, shard, started_at, wall_seconds, status in runs:
+        run_labels[run_id] = {"run_type": run_type, "shard": shard}
+        labels = format_labels({**run_labels[run_id], "status": status})
+        lines.append(f"swetrix_run_wall_seconds{{{labels}}} {wall_seconds}")
+
+    lines += [
+        "# HELP swetrix_run_started_timestamp_seconds Start of the latest run",
+        "# TYPE swetrix_run_started_timestamp_seconds gauge",
+    ]
+    for run_id, _, _, started_at, _, _ in runs:
+        labels = format_labels(run_labels[run_id])
+        timestamp = datetime.fromisoformat(started_at).timestamp()
+        lines.append(
+            f"swetrix_run_started_timestamp_seconds{{{labels}}} {timestamp}"
+        )
+
+    if not runs:
+        return "\n".join(lines) + "\n"
+
+    placeholders = ", ".join("?" for _ in run_labels)
+    stages = sqlite_client.execute_query(
+        f"""
+        SELECT run_id, stage, status, {", ".join(m for m, _ in stage_metrics)}
+        FROM run_report_stages
+        WHERE run_id IN ({placeholders})
+        ORDER BY run_id, position
+        """,
+        tuple(run_labels),
+    )
+    for index, (metric, description) in enumerate(stage_metrics):
+        lines += [
+            f"# HELP swetrix_stage_{metric} {description}",
+            f"# TYPE swetrix_stage_{metric} gauge",
+        ]
+        for run_id, name, status, *values in stages:
+            if values[index] is None:
+                continue
+            labels = format_labels(
+                {**run_labels[run_id], "stage": name, "status": status}
+            )
+            lines.append(f"swetrix_stage_{metric}{{{labels}}} {values[index]}")
+
+    return "\n".join(lines) + "\n"